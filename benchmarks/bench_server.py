@@ -0,0 +1,433 @@
+"""
+Бенчмарки горячих путей сервера. Работают без сети и без запущенного сервера:
+модуль server/app.py импортируется напрямую, запросы идут через Flask test client.
+
+    cd benchmarks
+    python bench_server.py run --json results.json
+    python bench_server.py run --only jwt,get_data --repeat 9
+    python bench_server.py run --json results.json --compare baseline.json --threshold 0.15
+    python bench_server.py compare results.json baseline.json
+
+Базовая линия — это просто сохранённый результат run на той же машине
+(cp results.json baseline.json). Сравниваются медианы; замедление больше
+threshold отмечается как регрессия, и compare завершается с кодом 1.
+
+Модель YOLO загружается до начала замеров и только из server/yolov8n.pt:
+если файла нет (или задан --no-model), сервер импортируется без модели
+(SAFE_SCHOOL_NO_YOLO=1), ничего не скачивается, а бенчмарки detect и pipeline
+пропускаются. Результаты, снятые с моделью и без неё (или на другой машине),
+compare не сравнивает без --force. Кадры синтетические и одинаковые при
+каждом запуске (фиксированный seed).
+"""
+import argparse
+import base64
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+
+import cv2
+import jwt
+import numpy as np
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server')
+BENCH_SCHOOL = 'bench_school'
+MODEL_FILE = os.path.join(SERVER_DIR, 'yolov8n.pt')
+MODEL_MIN_BYTES = 6_000_000  # меньший файл app.load_yolo считает повреждённым и скачивает заново
+YOLO_WAIT = 300  # секунд ожидания загрузки модели до начала замеров
+# Поля meta, которые должны совпадать, чтобы сравнение имело смысл
+COMPARABLE_META = ('yolo_loaded', 'python', 'platform', 'cpu_count', 'opencv')
+
+app = None  # server/app.py, импортируется в load_app()
+
+
+def load_app(use_model=True):
+    """Импорт сервера из его каталога (там ищутся yolov8n.pt и school_data.json).
+    Возвращается после завершения загрузки модели, чтобы она не шла параллельно с замерами."""
+    global app
+    model_available = os.path.exists(MODEL_FILE) and os.path.getsize(MODEL_FILE) >= MODEL_MIN_BYTES
+    if use_model and not model_available:
+        print(f'{os.path.abspath(MODEL_FILE)} not found, running without the model', file=sys.stderr)
+    if not (use_model and model_available):
+        os.environ['SAFE_SCHOOL_NO_YOLO'] = '1'
+    sys.path.insert(0, os.path.abspath(SERVER_DIR))
+    os.chdir(SERVER_DIR)
+    import app as server_app
+    app = server_app
+    if not app.yolo_ready.wait(YOLO_WAIT):
+        raise SystemExit(f'YOLO model did not load in {YOLO_WAIT} s')
+    # Журнал медленных запросов и INFO-логи не должны влиять на замеры
+    logging.getLogger().setLevel(logging.ERROR)
+    app.slow_requests.threshold = float('inf')
+    return app
+
+
+def measure(fn, repeat=5, number=100, warmup=1):
+    """Время одного вызова fn: repeat серий по number вызовов, статистика по сериям"""
+    for _ in range(warmup):
+        for _ in range(number):
+            fn()
+    per_call = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        per_call.append((time.perf_counter() - start) / number)
+    return summarize(per_call, number)
+
+
+def summarize(per_call, number, **extra):
+    per_call = sorted(per_call)
+    median = statistics.median(per_call)
+    return dict({
+        'median_ms': round(median * 1000, 4),
+        'min_ms': round(per_call[0] * 1000, 4),
+        'max_ms': round(per_call[-1] * 1000, 4),
+        'stdev_ms': round(statistics.stdev(per_call) * 1000, 4) if len(per_call) > 1 else 0.0,
+        'ops_per_s': round(1 / median, 1) if median > 0 else None,
+        'repeat': len(per_call),
+        'number': number,
+    }, **extra)
+
+
+def synthetic_frames(count, width=640, height=480, seed=0):
+    """Кадры-заглушки: градиентный фон, прямоугольные «фигуры» и номер кадра"""
+    rng = np.random.default_rng(seed)
+    frames = []
+    for i in range(count):
+        frame = np.full((height, width, 3), 90, np.uint8)
+        frame[:, :, 1] = np.linspace(40, 200, width, dtype=np.uint8)
+        for _ in range(6):
+            x, y = int(rng.integers(0, width - 80)), int(rng.integers(0, height - 160))
+            cv2.rectangle(frame, (x, y), (x + 60, y + 140), tuple(int(c) for c in rng.integers(0, 255, 3)), -1)
+        cv2.putText(frame, f'frame {i}', (20, 40), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+        frames.append(frame)
+    return frames
+
+
+def jpeg(frame, quality=70):
+    return cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+def auth_headers():
+    return {'Authorization': f'Bearer {app.generate_token(BENCH_SCHOOL)}'}
+
+
+def cleanup_school():
+    with app.data_lock:
+        app.data_store.pop(BENCH_SCHOOL, None)
+        app.dirty_sensors.pop(BENCH_SCHOOL, None)
+        for key in [k for k in app.data_last_seen if k[0] == BENCH_SCHOOL]:
+            del app.data_last_seen[key]
+    with app.camera_data_lock:
+        app.camera_data_store.pop(BENCH_SCHOOL, None)
+        app.dirty_cameras.pop(BENCH_SCHOOL, None)
+    app.occupancy_history.remove_school(BENCH_SCHOOL)
+    app.annotated_frames_store.remove_school(BENCH_SCHOOL)
+
+
+# --- Бенчмарки: каждый возвращает {имя: результат} ---
+
+def bench_jwt(args):
+    token = app.generate_token(BENCH_SCHOOL)
+    results = {
+        # Полная проверка подписи — то, что require_jwt делает при промахе кэша
+        'jwt.decode_hs256': measure(lambda: jwt.decode(token, app.SECRET_KEY, algorithms=['HS256']),
+                                    args.repeat, 2000),
+    }
+    view = app.require_jwt(lambda school_id: school_id)
+    with app.app.test_request_context(headers={'Authorization': f'Bearer {token}'}):
+        results['jwt.require_jwt_cached'] = measure(view, args.repeat, 2000)
+    return results
+
+
+def bench_receive_data(args):
+    client_headers = auth_headers()
+    results = {}
+    per_thread = args.requests
+    for threads in (1, 4, 16):
+        cleanup_school()
+        barrier = threading.Barrier(threads + 1)
+        errors = [0]
+
+        def worker(n):
+            client = app.app.test_client()
+            body = {'sensor_id': f'sensor_{n}', 'temperature': 21.5}
+            barrier.wait()
+            for _ in range(per_thread):
+                if client.post('/sensor-data', json=body, headers=client_headers).status_code != 200:
+                    errors[0] += 1
+
+        runs = []
+        for _ in range(args.repeat):
+            barrier.reset()
+            workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+            for t in workers:
+                t.start()
+            barrier.wait()
+            start = time.perf_counter()
+            for t in workers:
+                t.join()
+            runs.append((time.perf_counter() - start) / (threads * per_thread))
+        results[f'receive_data.threads_{threads}'] = summarize(runs, threads * per_thread, errors=errors[0])
+    cleanup_school()
+    return results
+
+
+def bench_get_data(args):
+    client = app.app.test_client()
+    headers = auth_headers()
+    results = {}
+    now = int(time.time())
+    for sensors in (10, 100, 1000):
+        cleanup_school()
+        with app.data_lock:
+            school = app.data_store[BENCH_SCHOOL]
+            for n in range(sensors):
+                school[f'sensor_{n}'] = deque(({'value': 20 + (i % 50) / 10, 'timestamp': now - i}
+                                               for i in range(100)), maxlen=100)
+        size = len(client.get('/sensor-data', headers=headers).data)
+        number = max(3, 2000 // sensors)
+        results[f'get_data.sensors_{sensors}'] = dict(
+            measure(lambda: client.get('/sensor-data', headers=headers), args.repeat, number),
+            response_bytes=size)
+    cleanup_school()
+    return results
+
+
+def bench_frame_codec(args):
+    results = {}
+    for width, height in ((640, 480), (1280, 720)):
+        frame = synthetic_frames(1, width, height)[0]
+        data = jpeg(frame)
+        b64 = base64.b64encode(data).decode('ascii')
+        tag = f'{width}x{height}'
+        results[f'frame.b64decode_{tag}'] = measure(lambda: base64.b64decode(b64), args.repeat, 200)
+        results[f'frame.decode_{tag}'] = measure(lambda: app.decode_frame(data), args.repeat, 50)
+        results[f'frame.encode_thumbnail_{tag}'] = measure(lambda: app.encode_renditions(frame, False), args.repeat, 50)
+        results[f'frame.encode_full_{tag}'] = measure(lambda: app.encode_renditions(frame, True), args.repeat, 50)
+    return results
+
+
+def bench_detect(args):
+    if app.yolo_model is None:
+        return {'detect.people_with_boxes': {'skipped': 'yolo model not available'}}
+    frames = synthetic_frames(8)
+    index = [0]
+
+    def detect():
+        # Детектор рисует рамки на кадре — даём ему копию
+        frame = frames[index[0] % len(frames)].copy()
+        index[0] += 1
+        app.detect_people_with_boxes(frame)
+
+    return {'detect.people_with_boxes': measure(detect, args.repeat, 10)}
+
+
+def bench_pipeline(args):
+    """Кадр целиком через конвейер (без HTTP): decode -> ... -> publish"""
+    if app.yolo_model is None:
+        # Без модели замер показал бы только накладные расходы и не сравнивался бы с замером с моделью
+        skipped = {'skipped': 'yolo model not available'}
+        return {'pipeline.frame': skipped, 'pipeline.frame_annotated': dict(skipped)}
+    frames = [jpeg(f) for f in synthetic_frames(8)]
+    index = [0]
+
+    def run(annotate):
+        def process():
+            data = frames[index[0] % len(frames)]
+            index[0] += 1
+            app.process_frame(BENCH_SCHOOL, 'bench_camera', data, annotate=annotate)
+        return process
+
+    results = {
+        'pipeline.frame': measure(run(False), args.repeat, 10),
+        'pipeline.frame_annotated': measure(run(True), args.repeat, 10),
+    }
+    cleanup_school()
+    return results
+
+
+def synthetic_layout(schools):
+    """Школы с тремя этажами, 20 датчиками и 10 камерами на этаж"""
+    floor = [{'x': x * 10, 'y': (x * 7) % 300} for x in range(12)]
+    schools_store, floors, versions = {}, defaultdict(list), {}
+    sensors = defaultdict(lambda: defaultdict(dict))
+    cameras = defaultdict(lambda: defaultdict(dict))
+    for s in range(schools):
+        sid = f'school_{s}'
+        schools_store[sid] = {'name': f'Школа №{s}', 'password_hash': '0' * 64, 'created_at': 1700000000}
+        floors[sid] = [floor for _ in range(3)]
+        versions[sid] = s
+        for f in range(3):
+            sensors[sid][f] = {f'sensor_{f}_{n}': {'x': n * 13 % 500, 'y': n * 17 % 400} for n in range(20)}
+            cameras[sid][f] = {f'camera_{f}_{n}': {'x': n * 29 % 500, 'y': n * 31 % 400} for n in range(10)}
+    return schools_store, sensors, cameras, floors, versions
+
+
+def bench_save_data(args):
+    names = ('schools_store', 'sensor_positions_store', 'camera_positions_store', 'floors_store',
+             'layout_versions', 'DATA_FILE')
+    saved = {name: getattr(app, name) for name in names}
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            app.DATA_FILE = os.path.join(tmp, 'school_data.json')
+            for schools in (10, 100, 1000):
+                (app.schools_store, app.sensor_positions_store, app.camera_positions_store,
+                 app.floors_store, app.layout_versions) = synthetic_layout(schools)
+                number = max(1, 200 // schools)
+                result = measure(app.save_data, args.repeat, number)
+                result['file_bytes'] = os.path.getsize(app.DATA_FILE)
+                results[f'save_data.schools_{schools}'] = result
+        finally:
+            for name, value in saved.items():
+                setattr(app, name, value)
+    return results
+
+
+BENCHMARKS = {
+    'jwt': bench_jwt,
+    'receive_data': bench_receive_data,
+    'get_data': bench_get_data,
+    'frame_codec': bench_frame_codec,
+    'detect': bench_detect,
+    'pipeline': bench_pipeline,
+    'save_data': bench_save_data,
+}
+
+
+def run(args):
+    load_app(use_model=not args.no_model)
+    selected = args.only.split(',') if args.only else list(BENCHMARKS)
+    unknown = [name for name in selected if name not in BENCHMARKS]
+    if unknown:
+        raise SystemExit(f'Unknown benchmarks: {", ".join(unknown)}; available: {", ".join(BENCHMARKS)}')
+    results = {}
+    for name in selected:
+        print(f'running {name}...', file=sys.stderr)
+        results.update(BENCHMARKS[name](args))
+    return {
+        'meta': {
+            'timestamp': int(time.time()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'opencv': cv2.__version__,
+            'yolo_loaded': app.yolo_model is not None,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+
+
+def meta_mismatches(current, baseline):
+    """[(поле, текущее, базовое)] для полей meta, при расхождении которых медианы несравнимы"""
+    cur, base = current.get('meta', {}), baseline.get('meta', {})
+    return [(field, cur.get(field), base.get(field)) for field in COMPARABLE_META
+            if cur.get(field) != base.get(field)]
+
+
+def compare(current, baseline, threshold):
+    """Строки сравнения медиан и список регрессий"""
+    rows, regressions = [], []
+    for name, cur in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None or 'median_ms' not in cur or 'median_ms' not in base:
+            rows.append({'benchmark': name, 'status': 'new' if base is None else 'skipped'})
+            continue
+        ratio = cur['median_ms'] / base['median_ms'] if base['median_ms'] > 0 else float('inf')
+        if ratio > 1 + threshold:
+            status = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            status = 'improved'
+        else:
+            status = 'ok'
+        rows.append({'benchmark': name, 'baseline_ms': base['median_ms'], 'current_ms': cur['median_ms'],
+                     'change_pct': round((ratio - 1) * 100, 1), 'status': status})
+    # Бенчмарки базовой линии, которых нет в текущем запуске (--only, переименование, удаление)
+    for name in baseline['results']:
+        if name not in current['results']:
+            rows.append({'benchmark': name, 'status': 'missing'})
+    return rows, regressions
+
+
+def print_comparison(rows):
+    print(f"{'benchmark':<40} {'baseline ms':>12} {'current ms':>12} {'change':>9}  status")
+    for row in rows:
+        if 'change_pct' in row:
+            print(f"{row['benchmark']:<40} {row['baseline_ms']:>12.4f} {row['current_ms']:>12.4f} "
+                  f"{row['change_pct']:>+8.1f}%  {row['status']}")
+        else:
+            print(f"{row['benchmark']:<40} {'':>12} {'':>12} {'':>9}  {row['status']}")
+
+
+def load_json(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Safe School server benchmarks')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run_p = sub.add_parser('run', help='Run benchmarks')
+    run_p.add_argument('--only', default=None, help=f'comma-separated subset of: {", ".join(BENCHMARKS)}')
+    run_p.add_argument('--repeat', type=int, default=5, help='timed series per benchmark')
+    run_p.add_argument('--requests', type=int, default=200, help='requests per thread in receive_data')
+    run_p.add_argument('--json', dest='json_out', default=None, help='write results to this file')
+    run_p.add_argument('--no-model', action='store_true', help='do not load YOLO; skip detect and pipeline')
+    run_p.add_argument('--compare', default=None, help='baseline results to compare against')
+    run_p.add_argument('--threshold', type=float, default=0.15, help='allowed slowdown, fraction of baseline')
+    run_p.add_argument('--force', action='store_true', help='compare even if result metadata differs')
+
+    cmp_p = sub.add_parser('compare', help='Compare two result files')
+    cmp_p.add_argument('current')
+    cmp_p.add_argument('baseline')
+    cmp_p.add_argument('--threshold', type=float, default=0.15)
+    cmp_p.add_argument('--force', action='store_true', help='compare even if result metadata differs')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        if args.repeat < 2:
+            parser.error('--repeat must be at least 2')
+        # Пути к файлам — относительно каталога запуска, а не server/
+        json_out = os.path.abspath(args.json_out) if args.json_out else None
+        baseline_path = os.path.abspath(args.compare) if args.compare else None
+        current = run(args)
+        if json_out:
+            with open(json_out, 'w', encoding='utf-8') as f:
+                json.dump(current, f, indent=2)
+        else:
+            print(json.dumps(current, indent=2))
+        if baseline_path is None:
+            return
+        baseline = load_json(baseline_path)
+    else:
+        current, baseline = load_json(args.current), load_json(args.baseline)
+
+    mismatches = meta_mismatches(current, baseline)
+    for field, cur, base in mismatches:
+        print(f'meta mismatch: {field}: current={cur!r} baseline={base!r}')
+    if mismatches and not args.force:
+        print('results are not comparable; re-record the baseline or pass --force')
+        sys.exit(2)
+    rows, regressions = compare(current, baseline, args.threshold)
+    print_comparison(rows)
+    missing = [row['benchmark'] for row in rows if row['status'] == 'missing']
+    if missing:
+        print(f'{len(missing)} baseline benchmark(s) missing from this run: {", ".join(missing)}')
+    if regressions:
+        print(f'{len(regressions)} regression(s) over {args.threshold:.0%}: {", ".join(regressions)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,9 @@
 import threading
 import queue
-from collections import defaultdict, deque
+from collections import defaultdict, deque, OrderedDict
+from functools import wraps
 from flask import Flask, request, jsonify, Response
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room, leave_room
 import jwt
 import time
 import logging
@@ -14,13 +15,19 @@ import cv2
 import numpy as np
 from flask_cors import CORS
 from ultralytics import YOLO
+from occupancy_history import OccupancyHistory
+from capture import CaptureWriter
+from frame_store import FrameStore
+from scheduler import AdmissionControl, FairScheduler, JobDropped
+from pipeline import Pipeline, Stage, SchedulerStage, FrameContext, FrameSequencer, PipelineBusy
+from profiler import SamplingProfiler, SlowRequestLog, start_trace, end_trace, current_trace, span
 
 SECRET_KEY = 'supersecretkey'
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 
 app = Flask(__name__)
-CORS(app, resources={r"/*": {"origins": "*"}})
+CORS(app, resources={r"/*": {"origins": "*"}}, expose_headers=['ETag', 'X-People-Count', 'X-Frame-Timestamp', 'X-Frame-Rendition'])
 socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
 
 # --- Хранилища данных ---
@@ -30,6 +37,10 @@ schools_lock = threading.Lock()
 
 # school_id -> { sensor_id -> deque([measurements], maxlen=100) }
 data_store = defaultdict(lambda: defaultdict(lambda: deque(maxlen=100)))
+# Время последнего показания (по часам сервера): (school_id, sensor_id) -> timestamp
+data_last_seen = {}
+# Датчики, изменившиеся с последней рассылки: school_id -> {sensor_id} (под data_lock)
+dirty_sensors = defaultdict(set)
 data_lock = threading.Lock()
 
 # Координаты датчиков: school_id -> { floor_idx -> { sensor_id -> {x, y} } }
@@ -42,18 +53,34 @@ camera_positions_lock = threading.Lock()
 
 # Данные с камер (количество людей): school_id -> { camera_id -> { count, timestamp } }
 camera_data_store = defaultdict(dict)
+# Камеры, изменившиеся с последней рассылки: school_id -> {camera_id} (под camera_data_lock)
+dirty_cameras = defaultdict(set)
+# Камеры с новой миниатюрой с последней рассылки: school_id -> {camera_id} (под camera_data_lock)
+dirty_thumbnails = defaultdict(set)
 camera_data_lock = threading.Lock()
 
+# История заполненности (min/max/avg по интервалам 1 с / 1 мин / 15 мин / 1 ч)
+occupancy_history = OccupancyHistory()
+
 # Схемы этажей: school_id -> [floor_points, ...]
 floors_store = defaultdict(list)
 floors_lock = threading.Lock()
 
+# Версия планировки школы (этажи + позиции устройств): school_id -> int, растёт при каждом изменении
+layout_versions = {}
+layout_versions_lock = threading.Lock()
+
 # Файл для персистентного хранения
 DATA_FILE = 'school_data.json'
 
+# Запись входящего трафика для воспроизведения (python app.py --capture day.sscap)
+capture_writer = None
+
 # --- YOLO модель для детекции людей ---
 yolo_model = None
 yolo_lock = threading.Lock()
+# Выставляется, когда попытка загрузки модели завершилась (успешно или нет)
+yolo_ready = threading.Event()
 
 def load_yolo():
     global yolo_model
@@ -71,67 +98,94 @@ def load_yolo():
     except Exception as e:
         logging.error(f'Failed to load YOLO model: {e}')
         yolo_model = None
+    finally:
+        yolo_ready.set()
 
-# Загружаем YOLO в отдельном потоке чтобы не блокировать старт сервера
-threading.Thread(target=load_yolo, daemon=True).start()
+# Загружаем YOLO в отдельном потоке чтобы не блокировать старт сервера.
+# SAFE_SCHOOL_NO_YOLO=1 — без модели (и без её скачивания), например для бенчмарков
+if os.environ.get('SAFE_SCHOOL_NO_YOLO') == '1':
+    logging.warning('YOLO disabled by SAFE_SCHOOL_NO_YOLO')
+    yolo_ready.set()
+else:
+    threading.Thread(target=load_yolo, daemon=True).start()
 
-def detect_people(frame):
-    """Детектирует людей на кадре, возвращает количество"""
+def detect_people_boxes(frame):
+    """Единственный вызов детектора: bounding boxes людей на кадре"""
     global yolo_model
     if yolo_model is None:
         logging.warning('YOLO model not loaded, returning 0')
-        return 0
+        return []
     
-    with yolo_lock:
-        try:
+    # Ожидание модели и сама детекция — отдельные участки трассы
+    with span('yolo_lock'):
+        yolo_lock.acquire()
+    try:
+        with span('model'):
             # Детекция с пониженным порогом уверенности для лучшего обнаружения
             results = yolo_model(frame, verbose=False, conf=0.25)
-            # Класс 0 в COCO - это 'person'
-            people_count = 0
-            for r in results:
-                for box in r.boxes:
-                    if int(box.cls[0]) == 0:  # person class
-                        people_count += 1
-            return people_count
-        except Exception as e:
-            logging.error(f'Detection error: {e}')
-            return 0
+    except Exception as e:
+        # Ошибка детекции — ошибка кадра: она попадёт в счётчик failed школы
+        logging.error(f'Detection error: {e}')
+        raise
+    finally:
+        yolo_lock.release()
+    
+    boxes_list = []
+    for r in results:
+        for box in r.boxes:
+            if int(box.cls[0]) == 0:  # Класс 0 в COCO - это 'person'
+                x1, y1, x2, y2 = box.xyxy[0].tolist()
+                boxes_list.append({'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2, 'conf': float(box.conf[0])})
+    return boxes_list
+
+def draw_boxes(frame, boxes):
+    """Рисует bounding boxes на кадре (на месте)"""
+    for b in boxes:
+        cv2.rectangle(frame, (b['x1'], b['y1']), (b['x2'], b['y2']), (0, 255, 0), 2)
+        label = f'Person {b["conf"]:.2f}'
+        cv2.putText(frame, label, (b['x1'], b['y1'] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+    return frame
 
 def detect_people_with_boxes(frame):
     """Детектирует людей и возвращает кадр с bounding boxes и количество"""
-    global yolo_model
-    if yolo_model is None:
-        return frame, 0, []
-    
-    with yolo_lock:
-        try:
-            results = yolo_model(frame, verbose=False, conf=0.25)
-            people_count = 0
-            boxes_list = []
-            
-            for r in results:
-                for box in r.boxes:
-                    cls_id = int(box.cls[0])
-                    if cls_id == 0:  # person class
-                        people_count += 1
-                        # Получаем координаты bounding box
-                        x1, y1, x2, y2 = map(int, box.xyxy[0].tolist())
-                        conf = float(box.conf[0])
-                        boxes_list.append({'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2, 'conf': conf})
-                        
-                        # Рисуем bounding box на кадре
-                        cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                        label = f'Person {conf:.2f}'
-                        cv2.putText(frame, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
-            
-            return frame, people_count, boxes_list
-        except Exception as e:
-            logging.error(f'Detection with boxes error: {e}')
-            return frame, 0, []
+    boxes = [{k: (int(v) if k != 'conf' else v) for k, v in b.items()} for b in detect_people_boxes(frame)]
+    return draw_boxes(frame, boxes), len(boxes), boxes
+
+# --- Допуск кадров и очередь на детектор ---
+FRAME_RATE_PER_SCHOOL = 30     # кадров/с на школу
+FRAME_BURST_PER_SCHOOL = 60
+FRAME_RATE_PER_CAMERA = 10     # кадров/с на камеру
+FRAME_BURST_PER_CAMERA = 20
+INFERENCE_QUEUE_PER_SCHOOL = 8  # сверх этого вытесняются самые старые кадры школы
+INFERENCE_TIMEOUT = 10          # секунд ожидания результата обработки кадра
+SCHOOL_WEIGHTS = {}             # school_id -> вес в round-robin (по умолчанию 1)
+
+frame_admission = AdmissionControl(FRAME_RATE_PER_SCHOOL, FRAME_BURST_PER_SCHOOL,
+                                   FRAME_RATE_PER_CAMERA, FRAME_BURST_PER_CAMERA)
+inference_scheduler = FairScheduler(frame_admission.stats, max_queue_per_school=INFERENCE_QUEUE_PER_SCHOOL,
+                                    weights=SCHOOL_WEIGHTS)
+
+# Камеры с активной тревогой: (school_id, camera_id) -> действует до (unix-время)
+camera_alerts = {}
+camera_alerts_lock = threading.Lock()
+
+def is_priority_camera(school_id, camera_id):
+    """Кадры просматриваемых камер и камер с тревогой обрабатываются первыми"""
+    with camera_alerts_lock:
+        alert_until = camera_alerts.get((school_id, camera_id))
+    if alert_until is not None and alert_until > time.time():
+        return True
+    return has_active_viewer(school_id, camera_id)
+
+def admission_rejected(retry_after):
+    response = jsonify({'error': 'Frame rate quota exceeded', 'retry_after': round(retry_after, 3)})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+    return response
 
 # --- Функции загрузки/сохранения данных ---
 def load_data():
-    global sensor_positions_store, floors_store, schools_store, camera_positions_store
+    global sensor_positions_store, floors_store, schools_store, camera_positions_store, layout_versions
     if os.path.exists(DATA_FILE):
         try:
             with open(DATA_FILE, 'r', encoding='utf-8') as f:
@@ -153,6 +207,9 @@ def load_data():
                 # Загрузка этажей
                 for school_id, floors in data.get('floors', {}).items():
                     floors_store[school_id] = floors
+                
+                # Загрузка версий планировки
+                layout_versions = data.get('layout_versions', {})
                     
                 logging.info('Data loaded from file')
         except Exception as e:
@@ -164,7 +221,8 @@ def save_data():
             'schools': schools_store,
             'sensor_positions': {k: {str(fk): fv for fk, fv in v.items()} for k, v in sensor_positions_store.items()},
             'camera_positions': {k: {str(fk): fv for fk, fv in v.items()} for k, v in camera_positions_store.items()},
-            'floors': dict(floors_store)
+            'floors': dict(floors_store),
+            'layout_versions': layout_versions
         }
         with open(DATA_FILE, 'w', encoding='utf-8') as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
@@ -182,20 +240,69 @@ def generate_token(school_id):
     payload = {'school_id': school_id, 'exp': int(time.time()) + 60*60*24}
     return jwt.encode(payload, SECRET_KEY, algorithm='HS256')
 
+# Кэш проверенных токенов: sha256(token) -> (school_id, действителен до).
+# Симуляторы присылают один и тот же токен тысячи раз, поэтому полная проверка
+# подписи выполняется один раз, дальше — поиск в словаре и сравнение с exp.
+JWT_CACHE_SIZE = 4096
+JWT_CACHE_MAX_AGE = 300  # секунд; не дольше этого держим запись даже для долгоживущего токена
+jwt_cache = OrderedDict()
+jwt_cache_lock = threading.Lock()
+jwt_cache_stats = {'hits': 0, 'misses': 0, 'evicted': 0}
+
+def verify_token(token):
+    """Возвращает school_id из токена; исключение PyJWT/KeyError, если токен недействителен"""
+    digest = hashlib.sha256(token.encode()).digest()
+    now = time.time()
+    with jwt_cache_lock:
+        cached = jwt_cache.get(digest)
+        if cached is not None:
+            if cached[1] > now:
+                jwt_cache.move_to_end(digest)
+                jwt_cache_stats['hits'] += 1
+                return cached[0]
+            del jwt_cache[digest]
+        jwt_cache_stats['misses'] += 1
+    
+    payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+    school_id = payload['school_id']
+    valid_until = now + JWT_CACHE_MAX_AGE
+    if 'exp' in payload:
+        valid_until = min(valid_until, payload['exp'])
+    
+    with jwt_cache_lock:
+        jwt_cache[digest] = (school_id, valid_until)
+        jwt_cache.move_to_end(digest)
+        while len(jwt_cache) > JWT_CACHE_SIZE:
+            # Вытесняем самую давно использованную запись; истёкшие удаляет фоновая очистка
+            jwt_cache.popitem(last=False)
+            jwt_cache_stats['evicted'] += 1
+    return school_id
+
+def purge_jwt_cache(now=None):
+    now = now if now is not None else time.time()
+    with jwt_cache_lock:
+        expired = [digest for digest, (_, valid_until) in jwt_cache.items() if valid_until <= now]
+        for digest in expired:
+            del jwt_cache[digest]
+        jwt_cache_stats['evicted'] += len(expired)
+    return len(expired)
+
 def require_jwt(f):
-    from functools import wraps
     @wraps(f)
     def wrapper(*args, **kwargs):
         auth = request.headers.get('Authorization', None)
         if not auth or not auth.startswith('Bearer '):
             return jsonify({'error': 'Missing or invalid Authorization header'}), 401
-        token = auth.split(' ', 1)[1]
+        token = auth[7:]
         try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
-            school_id = payload['school_id']
+            with span('auth'):
+                school_id = verify_token(token)
         except Exception as e:
             logging.error(f'JWT error: {e}')
             return jsonify({'error': 'Invalid token', 'details': str(e)}), 401
+        trace = current_trace()
+        if trace is not None:
+            trace.attrs['school_id'] = school_id
         return f(school_id, *args, **kwargs)
     return wrapper
 
@@ -261,6 +368,9 @@ def login_school():
 @app.route('/get-token/<school_id>')
 def get_token(school_id):
     """Получить токен для школы (для тестирования/симулятора)"""
+    with schools_lock:
+        if school_id not in schools_store:
+            return jsonify({'error': 'School not found'}), 404
     token = generate_token(school_id)
     return jsonify({'token': token, 'school_id': school_id})
 
@@ -268,27 +378,123 @@ def get_token(school_id):
 @app.route('/sensor-data', methods=['POST'])
 @require_jwt
 def receive_data(school_id):
-    data = request.get_json(force=True)
+    with span('parse'):
+        data = request.get_json(force=True)
     sensor_id = data.get('sensor_id')
     # Поддержка обоих ключей: 'value' и 'temperature'
     value = data.get('temperature') or data.get('value')
     timestamp = data.get('timestamp', int(time.time()))
     if not sensor_id or value is None:
         return jsonify({'error': 'sensor_id and value/temperature required'}), 400
-    with data_lock:
-        data_store[school_id][sensor_id].append({'value': value, 'timestamp': timestamp})
+    with span('store'):
+        with data_lock:
+            data_store[school_id][sensor_id].append({'value': value, 'timestamp': timestamp})
+            data_last_seen[(school_id, sensor_id)] = time.time()
+            dirty_sensors[school_id].add(sensor_id)
+    if capture_writer is not None:
+        try:
+            with span('capture'):
+                capture_writer.record_sensor(school_id, sensor_id, value, timestamp)
+        except Exception as e:
+            logging.error(f'Capture error: {e}')
     return jsonify({'status': 'ok'})
 
 @app.route('/sensor-data', methods=['GET'])
 @require_jwt
 def get_data(school_id):
     sensor_id = request.args.get('sensor_id')
-    with data_lock:
+    with span('copy'), data_lock:
+        # Чтение не должно создавать записи в defaultdict
+        sensors = data_store.get(school_id, {})
         if sensor_id:
-            data = list(data_store[school_id][sensor_id])
+            data = list(sensors.get(sensor_id, ()))
         else:
-            data = {sid: list(queue) for sid, queue in data_store[school_id].items()}
-    return jsonify({'data': data})
+            data = {sid: list(queue) for sid, queue in sensors.items()}
+    with span('serialize'):
+        return jsonify({'data': data})
+
+# --- API: Планировка школы целиком (этажи + позиции устройств) ---
+def bump_layout_version(school_id):
+    with layout_versions_lock:
+        version = layout_versions.get(school_id, 0) + 1
+        layout_versions[school_id] = version
+    return version
+
+def announce_layout_version(school_id, version):
+    """Сообщает клиентам о новой версии планировки, чтобы они перезапросили /layout"""
+    # Только клиентам этой школы (комната после subscribe), как live_update
+    socketio.emit('layout_version', {'school_id': school_id, 'version': version},
+                  to=school_room(school_id), namespace='/')
+
+def layout_etag(school_id, version):
+    return f'{hashlib.sha1(school_id.encode()).hexdigest()[:8]}-{version}'
+
+def parse_positions(value):
+    """{floor_idx: {device_id: {x, y}}} -> {int: dict}; ValueError при неверном формате"""
+    if not isinstance(value, dict):
+        raise ValueError('positions must be an object keyed by floor index')
+    parsed = {}
+    for floor_idx, devices in value.items():
+        if not isinstance(devices, dict):
+            raise ValueError(f'positions for floor {floor_idx} must be an object')
+        parsed[int(floor_idx)] = devices
+    return parsed
+
+@app.route('/layout', methods=['GET'])
+@require_jwt
+def get_layout(school_id):
+    """Этажи и позиции всех устройств одним запросом; поддерживает If-None-Match"""
+    with floors_lock, sensor_positions_lock, camera_positions_lock:
+        with layout_versions_lock:
+            version = layout_versions.get(school_id, 0)
+        etag = layout_etag(school_id, version)
+        if etag in request.if_none_match:
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        layout = {
+            'version': version,
+            'floors': floors_store.get(school_id, []),
+            'sensor_positions': {str(k): v for k, v in sensor_positions_store.get(school_id, {}).items()},
+            'camera_positions': {str(k): v for k, v in camera_positions_store.get(school_id, {}).items()}
+        }
+        response = jsonify(layout)
+    response.set_etag(etag)
+    return response
+
+@app.route('/layout', methods=['PUT'])
+@require_jwt
+def update_layout(school_id):
+    """Пакетное обновление планировки: переданные разделы (floors, sensor_positions,
+    camera_positions) заменяются целиком, всё применяется вместе с одной записью на диск"""
+    data = request.get_json(force=True)
+    floors = data.get('floors')
+    try:
+        if floors is not None and not isinstance(floors, list):
+            raise ValueError('floors must be a list')
+        sensor_positions = parse_positions(data['sensor_positions']) if 'sensor_positions' in data else None
+        camera_positions = parse_positions(data['camera_positions']) if 'camera_positions' in data else None
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': str(e)}), 400
+    
+    with floors_lock, sensor_positions_lock, camera_positions_lock:
+        with layout_versions_lock:
+            current = layout_versions.get(school_id, 0)
+        # Оптимистичная блокировка: клиент может прислать If-Match с ETag прочитанной версии
+        if request.if_match and layout_etag(school_id, current) not in request.if_match:
+            return jsonify({'error': 'Layout was modified', 'version': current}), 412
+        if floors is not None:
+            floors_store[school_id] = floors
+        for store, positions in ((sensor_positions_store, sensor_positions), (camera_positions_store, camera_positions)):
+            if positions is not None:
+                store[school_id].clear()
+                store[school_id].update(positions)
+        version = bump_layout_version(school_id)
+    save_data()
+    announce_layout_version(school_id, version)
+    response = jsonify({'status': 'ok', 'version': version})
+    response.set_etag(layout_etag(school_id, version))
+    return response
 
 # --- API: Схемы этажей ---
 @app.route('/floors', methods=['GET'])
@@ -305,8 +511,11 @@ def save_floors(school_id):
     floors = data.get('floors', [])
     with floors_lock:
         floors_store[school_id] = floors
+        # Версия меняется вместе с содержимым: GET /layout читает их под теми же блокировками
+        version = bump_layout_version(school_id)
     save_data()
-    return jsonify({'status': 'ok'})
+    announce_layout_version(school_id, version)
+    return jsonify({'status': 'ok', 'version': version})
 
 # --- API: Позиции датчиков ---
 @app.route('/sensor-positions', methods=['GET'])
@@ -314,10 +523,11 @@ def save_floors(school_id):
 def get_sensor_positions(school_id):
     floor_idx = request.args.get('floor_idx')
     with sensor_positions_lock:
+        school_positions = sensor_positions_store.get(school_id, {})
         if floor_idx is not None:
-            positions = sensor_positions_store[school_id].get(int(floor_idx), {})
+            positions = school_positions.get(int(floor_idx), {})
         else:
-            positions = dict(sensor_positions_store[school_id])
+            positions = dict(school_positions)
     return jsonify({'positions': positions})
 
 @app.route('/sensor-positions', methods=['POST'])
@@ -330,8 +540,10 @@ def save_sensor_positions(school_id):
         return jsonify({'error': 'floor_idx required'}), 400
     with sensor_positions_lock:
         sensor_positions_store[school_id][int(floor_idx)] = positions
+        version = bump_layout_version(school_id)
     save_data()
-    return jsonify({'status': 'ok'})
+    announce_layout_version(school_id, version)
+    return jsonify({'status': 'ok', 'version': version})
 
 # --- API: Позиции камер ---
 @app.route('/camera-positions', methods=['GET'])
@@ -339,10 +551,11 @@ def save_sensor_positions(school_id):
 def get_camera_positions(school_id):
     floor_idx = request.args.get('floor_idx')
     with camera_positions_lock:
+        school_positions = camera_positions_store.get(school_id, {})
         if floor_idx is not None:
-            positions = camera_positions_store[school_id].get(int(floor_idx), {})
+            positions = school_positions.get(int(floor_idx), {})
         else:
-            positions = dict(camera_positions_store[school_id])
+            positions = dict(school_positions)
     return jsonify({'positions': positions})
 
 @app.route('/camera-positions', methods=['POST'])
@@ -355,8 +568,10 @@ def save_camera_positions(school_id):
         return jsonify({'error': 'floor_idx required'}), 400
     with camera_positions_lock:
         camera_positions_store[school_id][int(floor_idx)] = positions
+        version = bump_layout_version(school_id)
     save_data()
-    return jsonify({'status': 'ok'})
+    announce_layout_version(school_id, version)
+    return jsonify({'status': 'ok', 'version': version})
 
 # --- API: Данные камер (количество людей) ---
 @app.route('/camera-data', methods=['GET'])
@@ -366,151 +581,740 @@ def get_camera_data(school_id):
         data = dict(camera_data_store.get(school_id, {}))
     return jsonify({'data': data})
 
-# --- API: Загрузка видео кадров (для симулятора) ---
-@app.route('/video-frame', methods=['POST'])
+@app.route('/occupancy-history', methods=['GET'])
 @require_jwt
-def receive_video_frame(school_id):
-    """Получение кадра видео, детекция людей"""
-    data = request.get_json(force=True)
+def get_occupancy_history(school_id):
+    """История количества людей по камерам за интервал [start, end]"""
+    now = int(time.time())
+    try:
+        end = int(request.args.get('end', now))
+        start = int(request.args.get('start', end - 3600))
+        max_points = int(request.args.get('max_points', 500))
+        resolution = request.args.get('resolution')
+        resolution = int(resolution) if resolution else None
+    except ValueError:
+        return jsonify({'error': 'start, end, resolution and max_points must be integers'}), 400
+    if start > end or max_points <= 0:
+        return jsonify({'error': 'start must not exceed end, max_points must be positive'}), 400
+
+    camera_ids = request.args.get('camera_id')
+    if camera_ids:
+        camera_ids = [cid for cid in camera_ids.split(',') if cid]
+    else:
+        camera_ids = occupancy_history.cameras(school_id)
+
+    try:
+        resolution, series = occupancy_history.query(school_id, camera_ids, start, end, resolution, max_points)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    peaks = {cid: max((p['max'] for p in points), default=None) for cid, points in series.items()}
+    return jsonify({'start': start, 'end': end, 'resolution': resolution, 'series': series, 'peak': peaks})
+
+# --- API: Загрузка видео кадров (для симулятора) ---
+class InvalidFrame(ValueError):
+    pass
+
+def decode_frame(frame_bytes):
+    nparr = np.frombuffer(frame_bytes, np.uint8)
+    frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    if frame is None:
+        raise InvalidFrame('Invalid frame data')
+    return frame
+
+# Последние аннотированные кадры (JPEG-байты) с общим лимитом памяти и удалением молчащих камер
+FRAME_STORE_MAX_BYTES = 64 * 1024 * 1024
+FRAME_STORE_TTL = 300  # секунд без кадров, после которых камера удаляется
+annotated_frames_store = FrameStore(max_bytes=FRAME_STORE_MAX_BYTES, ttl=FRAME_STORE_TTL)
+
+# Разрешения кадров: миниатюра строится для каждой камеры, полный кадр — только если его смотрят
+THUMBNAIL_WIDTH = 160
+THUMBNAIL_JPEG_QUALITY = 60
+FULL_JPEG_QUALITY = 75
+VIEWER_LEASE_TTL = 5  # секунд после последнего GET /camera-stream, пока камера считается просматриваемой
+
+# Зрители камер: (school_id, camera_id) -> {sid} по WebSocket и -> время последнего HTTP-запроса
+camera_viewers = defaultdict(set)
+viewer_sessions = defaultdict(set)  # sid -> {(school_id, camera_id)}
+http_viewer_leases = {}
+camera_viewers_lock = threading.Lock()
+
+def school_room(school_id):
+    return f'school:{school_id}'
+
+def camera_room(school_id, camera_id):
+    return f'camera:{school_id}:{camera_id}'
+
+def has_active_viewer(school_id, camera_id):
+    key = (school_id, camera_id)
+    with camera_viewers_lock:
+        if camera_viewers.get(key):
+            return True
+        lease = http_viewer_leases.get(key)
+    return lease is not None and lease >= time.time() - VIEWER_LEASE_TTL
+
+def encode_renditions(frame, full):
+    """JPEG-миниатюра всегда, полный кадр — только при full=True"""
+    h, w = frame.shape[:2]
+    thumb_w = min(THUMBNAIL_WIDTH, w)
+    thumb = cv2.resize(frame, (thumb_w, max(1, h * thumb_w // w)), interpolation=cv2.INTER_AREA)
+    _, thumb_buf = cv2.imencode('.jpg', thumb, [cv2.IMWRITE_JPEG_QUALITY, THUMBNAIL_JPEG_QUALITY])
+    renditions = {'thumbnail': thumb_buf.tobytes(), 'full': None}
+    if full:
+        _, full_buf = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, FULL_JPEG_QUALITY])
+        renditions['full'] = full_buf.tobytes()
+    return renditions
+
+# --- Конвейер обработки кадров ---
+# decode -> preprocess -> infer -> postprocess -> render -> store -> publish.
+# У каждой стадии своя очередь и потоки, так что пока детектор занят одним кадром,
+# следующие уже декодируются, а предыдущие кодируются в JPEG и рассылаются.
+# Стадия infer — это FairScheduler (очередь по школам, взвешенный round-robin).
+# Опции кадра: annotate — рисовать рамки, хранить и рассылать кадр; return_frame — вернуть JPEG.
+PIPELINE_QUEUE_SIZE = 32       # кадров в очереди каждой стадии; при заполненной первой — 503
+INFERENCE_MAX_SIDE = 640       # YOLO всё равно приводит кадр к 640 — уменьшаем заранее, вне yolo_lock
+PIPELINE_WORKERS = {'decode': 2, 'preprocess': 1, 'postprocess': 1, 'render': 2, 'store': 1, 'publish': 1}
+
+def stage_decode(ctx):
+    ctx.data['frame'] = decode_frame(ctx.frame_bytes)
+    h, w = ctx.data['frame'].shape[:2]
+    logging.debug(f'Frame from {ctx.camera_id}: {w}x{h}')
+
+def stage_preprocess(ctx):
+    frame = ctx.data['frame']
+    h, w = frame.shape[:2]
+    scale = min(1.0, INFERENCE_MAX_SIDE / max(h, w))
+    if scale < 1.0:
+        frame = cv2.resize(frame, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+    ctx.data['input'] = frame
+    ctx.data['scale'] = scale
+
+def stage_infer(ctx):
+    ctx.data['detections'] = detect_people_boxes(ctx.data.pop('input'))
+
+def stage_postprocess(ctx):
+    """Координаты рамок — в пикселях исходного кадра"""
+    scale = ctx.data['scale']
+    boxes = [{
+        'x1': int(d['x1'] / scale), 'y1': int(d['y1'] / scale),
+        'x2': int(d['x2'] / scale), 'y2': int(d['y2'] / scale),
+        'conf': d['conf']
+    } for d in ctx.data.pop('detections')]
+    ctx.data['boxes'] = boxes
+    ctx.data['count'] = len(boxes)
+    ctx.data['timestamp'] = int(time.time())
+
+def stage_render(ctx):
+    # Полный кадр только если камеру смотрят или он нужен в ответе
+    need_full = ctx.options.get('return_frame') or has_active_viewer(ctx.school_id, ctx.camera_id)
+    with span('draw'):
+        frame = draw_boxes(ctx.data.pop('frame'), ctx.data['boxes'])
+    with span('encode'):
+        ctx.data['renditions'] = encode_renditions(frame, need_full)
+
+def stage_store(ctx):
+    school_id, camera_id = ctx.school_id, ctx.camera_id
+    # Кадр, обогнанный более новым кадром той же камеры, не должен затирать его результат
+    if not frame_sequencer.accept('store', (school_id, camera_id), ctx.seq):
+        ctx.data['stale'] = True
+        return
+    count = ctx.data['count']
+    renditions = ctx.data.get('renditions')
+    if renditions is not None:
+        annotated_frames_store.put(school_id, camera_id, renditions, count, ctx.data['boxes'], ctx.data['timestamp'])
+    with camera_data_lock:
+        camera_data_store[school_id][camera_id] = {
+            'count': count,
+            'timestamp': ctx.data['timestamp']
+        }
+        dirty_cameras[school_id].add(camera_id)
+        if renditions is not None:
+            dirty_thumbnails[school_id].add(camera_id)
+    occupancy_history.record(school_id, camera_id, count)
+    logging.info(f'Frame from {camera_id}: detected {count} people')
+
+def stage_publish(ctx):
+    # Полный кадр — сразу и только зрителям камеры (бинарное вложение Socket.IO, без base64).
+    # Миниатюры всем клиентам школы уходят объединённо, в live_update
+    school_id, camera_id = ctx.school_id, ctx.camera_id
+    if ctx.data.get('stale') or not frame_sequencer.accept('publish', (school_id, camera_id), ctx.seq):
+        return
+    renditions = ctx.data['renditions']
+    if renditions['full'] is None:
+        return
+    with span('emit.frame'):
+        socketio.emit('camera_frame', {
+            'school_id': school_id,
+            'camera_id': camera_id,
+            'count': ctx.data['count'],
+            'boxes': ctx.data['boxes'],
+            'timestamp': ctx.data['timestamp'],
+            'frame': renditions['full']
+        }, to=camera_room(school_id, camera_id), namespace='/')
+
+def frame_result(ctx):
+    result = {'status': 'ok', 'people_count': ctx.data['count']}
+    if ctx.options.get('annotate'):
+        result['boxes'] = ctx.data['boxes']
+    if ctx.options.get('return_frame'):
+        result['annotated_frame'] = ctx.data['renditions']['full']
+    return result
+
+def annotated(ctx):
+    return bool(ctx.options.get('annotate'))
+
+# Номера кадров камер: decode и render работают в несколько потоков, и кадры одной
+# камеры могут прийти в store/publish не по порядку
+frame_sequencer = FrameSequencer()
+
+def pipeline_stage(name, fn, when=None):
+    return Stage(name, fn, workers=PIPELINE_WORKERS[name], queue_size=PIPELINE_QUEUE_SIZE, when=when)
+
+frame_pipeline = Pipeline([
+    pipeline_stage('decode', stage_decode),
+    pipeline_stage('preprocess', stage_preprocess),
+    SchedulerStage('infer', stage_infer, inference_scheduler,
+                   priority=lambda ctx: is_priority_camera(ctx.school_id, ctx.camera_id)),
+    pipeline_stage('postprocess', stage_postprocess),
+    pipeline_stage('render', stage_render, when=annotated),
+    pipeline_stage('store', stage_store),
+    pipeline_stage('publish', stage_publish, when=annotated),
+], finalize=frame_result)
+frame_pipeline.start()
+
+def process_frame(school_id, camera_id, frame_bytes, annotate=False, return_frame=False):
+    """Прогоняет JPEG-кадр через конвейер и ждёт результат; общая для HTTP и WebSocket.
+    При return_frame в результат добавляется полный аннотированный JPEG (байты)."""
+    if capture_writer is not None:
+        try:
+            with span('capture'):
+                capture_writer.record_frame(school_id, camera_id, frame_bytes, annotated=annotate)
+        except Exception as e:
+            logging.error(f'Capture error: {e}')
+    ctx = FrameContext(school_id, camera_id, frame_bytes,
+                       {'annotate': annotate or return_frame, 'return_frame': return_frame},
+                       trace=current_trace(), seq=frame_sequencer.next((school_id, camera_id)))
+    return frame_pipeline.submit(ctx).wait(INFERENCE_TIMEOUT)
+
+def handle_video_frame(school_id, annotate):
+    """Общий обработчик /video-frame и /video-frame-annotated"""
+    with span('parse'):
+        data = request.get_json(force=True)
     camera_id = data.get('camera_id')
     frame_b64 = data.get('frame')  # base64 encoded JPEG
     
     if not camera_id or not frame_b64:
         return jsonify({'error': 'camera_id and frame required'}), 400
     
+    admitted, retry_after = frame_admission.admit(school_id, camera_id)
+    if not admitted:
+        return admission_rejected(retry_after)
+    
     try:
         # Декодируем изображение
-        frame_bytes = base64.b64decode(frame_b64)
-        nparr = np.frombuffer(frame_bytes, np.uint8)
-        frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        if frame is None:
-            logging.error(f'Failed to decode frame from {camera_id}, base64 length: {len(frame_b64)}')
-            return jsonify({'error': 'Invalid frame data'}), 400
-        
-        # Логируем размер кадра
-        h, w = frame.shape[:2]
-        logging.debug(f'Frame from {camera_id}: {w}x{h}')
-        
-        # Детектируем людей
-        people_count = detect_people(frame)
-        
-        # Сохраняем результат
-        with camera_data_lock:
-            camera_data_store[school_id][camera_id] = {
-                'count': people_count,
-                'timestamp': int(time.time())
-            }
-        
-        # Отправляем обновление через WebSocket
-        socketio.emit('camera_update', {
-            'school_id': school_id,
-            'camera_id': camera_id,
-            'count': people_count,
-            'timestamp': int(time.time())
-        }, namespace='/')
-        
-        logging.info(f'Frame from {camera_id}: detected {people_count} people')
-        return jsonify({'status': 'ok', 'people_count': people_count})
-        
+        with span('b64decode'):
+            frame_bytes = base64.b64decode(frame_b64)
+        result = process_frame(school_id, camera_id, frame_bytes, annotate, annotate and bool(data.get('return_frame')))
+        # Аннотированный кадр в ответе нужен только клиентам, которые явно его просят
+        if 'annotated_frame' in result:
+            result['annotated_frame'] = base64.b64encode(result['annotated_frame']).decode('utf-8')
+        return jsonify(result)
+    except InvalidFrame:
+        logging.error(f'Failed to decode frame from {camera_id}, base64 length: {len(frame_b64)}')
+        return jsonify({'error': 'Invalid frame data'}), 400
+    except (JobDropped, PipelineBusy) as e:
+        return jsonify({'error': 'Frame dropped', 'details': str(e)}), 503
     except Exception as e:
         logging.error(f'Error processing frame: {e}')
         return jsonify({'error': str(e)}), 500
 
-# Хранилище последних кадров с аннотациями: school_id -> camera_id -> { frame_b64, count, timestamp }
-annotated_frames_store = defaultdict(dict)
-annotated_frames_lock = threading.Lock()
+@app.route('/video-frame', methods=['POST'])
+@require_jwt
+def receive_video_frame(school_id):
+    """Получение кадра видео, детекция людей"""
+    return handle_video_frame(school_id, annotate=False)
 
 @app.route('/video-frame-annotated', methods=['POST'])
 @require_jwt
 def receive_video_frame_annotated(school_id):
     """Получение кадра, детекция людей с bounding boxes, возврат аннотированного кадра"""
+    return handle_video_frame(school_id, annotate=True)
+
+@app.route('/camera-alert', methods=['POST'])
+@require_jwt
+def set_camera_alert(school_id):
+    """Включить/выключить тревогу камеры (кадры такой камеры обрабатываются вне очереди)"""
     data = request.get_json(force=True)
     camera_id = data.get('camera_id')
-    frame_b64 = data.get('frame')
-    
-    if not camera_id or not frame_b64:
-        return jsonify({'error': 'camera_id and frame required'}), 400
-    
+    if not camera_id:
+        return jsonify({'error': 'camera_id required'}), 400
+    active = data.get('active', True)
     try:
-        # Декодируем изображение
-        frame_bytes = base64.b64decode(frame_b64)
-        nparr = np.frombuffer(frame_bytes, np.uint8)
-        frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        if frame is None:
-            return jsonify({'error': 'Invalid frame data'}), 400
-        
-        # Детектируем с bounding boxes
-        annotated_frame, people_count, boxes = detect_people_with_boxes(frame)
-        
-        # Кодируем обратно в JPEG
-        _, buffer = cv2.imencode('.jpg', annotated_frame, [cv2.IMWRITE_JPEG_QUALITY, 75])
-        annotated_b64 = base64.b64encode(buffer).decode('utf-8')
-        
-        # Сохраняем для просмотра
-        with annotated_frames_lock:
-            annotated_frames_store[school_id][camera_id] = {
-                'frame': annotated_b64,
-                'count': people_count,
-                'boxes': boxes,
-                'timestamp': int(time.time())
-            }
-        
-        # Сохраняем результат в общий store
-        with camera_data_lock:
-            camera_data_store[school_id][camera_id] = {
-                'count': people_count,
-                'timestamp': int(time.time())
-            }
-        
-        # WebSocket уведомление с кадром
-        socketio.emit('camera_frame', {
-            'school_id': school_id,
-            'camera_id': camera_id,
-            'frame': annotated_b64,
-            'count': people_count,
-            'boxes': boxes,
-            'timestamp': int(time.time())
-        }, namespace='/')
-        
-        return jsonify({
-            'status': 'ok',
-            'people_count': people_count,
-            'annotated_frame': annotated_b64,
-            'boxes': boxes
-        })
-        
-    except Exception as e:
-        logging.error(f'Error processing annotated frame: {e}')
-        return jsonify({'error': str(e)}), 500
+        ttl = float(data.get('ttl', 300))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'ttl must be a number'}), 400
+    with camera_alerts_lock:
+        if active:
+            camera_alerts[(school_id, camera_id)] = time.time() + ttl
+        else:
+            camera_alerts.pop((school_id, camera_id), None)
+    return jsonify({'status': 'ok'})
 
 @app.route('/camera-stream/<camera_id>', methods=['GET'])
 @require_jwt
 def get_camera_stream(school_id, camera_id):
-    """Получить последний аннотированный кадр с камеры"""
-    with annotated_frames_lock:
-        cam_data = annotated_frames_store.get(school_id, {}).get(camera_id)
+    """Получить последний аннотированный кадр с камеры.
+    ?size=thumbnail — миниатюра, иначе полный кадр (пока его нет — миниатюра); ?format=jpeg — сырой JPEG"""
+    rendition = 'thumbnail' if request.args.get('size') == 'thumbnail' else 'full'
+    if rendition == 'full':
+        # Запрос полного кадра делает камеру просматриваемой на VIEWER_LEASE_TTL секунд —
+        # только известную камеру: запросы к несуществующим id не создают записей
+        with camera_data_lock:
+            known = camera_id in camera_data_store.get(school_id, ())
+        if known:
+            with camera_viewers_lock:
+                http_viewer_leases[(school_id, camera_id)] = time.time()
+    
+    if request.args.get('format') == 'jpeg':
+        cam_data = annotated_frames_store.get_jpeg(school_id, camera_id, rendition)
+        if not cam_data:
+            return jsonify({'error': 'No frame available'}), 404
+        jpeg, meta = cam_data
+        return Response(jpeg, mimetype='image/jpeg', headers={
+            'X-People-Count': str(meta['count']),
+            'X-Frame-Timestamp': str(meta['timestamp']),
+            'X-Frame-Rendition': meta['rendition']
+        })
     
+    cam_data = annotated_frames_store.get_legacy(school_id, camera_id, rendition)
     if not cam_data:
         return jsonify({'error': 'No frame available'}), 404
     
     return jsonify(cam_data)
 
+# --- Профилирование и медленные запросы ---
+# Каждый HTTP-запрос и кадр /ingest получает трассу с участками (auth, parse, decode,
+# infer.queue, yolo_lock, model, encode, emit...); запросы дольше SLOW_REQUEST_THRESHOLD
+# попадают в журнал медленных запросов. Сэмплирующий профайлер включается по запросу.
+SLOW_REQUEST_THRESHOLD = 0.5   # секунд
+SLOW_REQUEST_LOG_SIZE = 200
+PROFILER_INTERVAL = 0.01       # секунд между снимками стеков
+DEBUG_ENDPOINTS = False        # /debug/*: включается флагом --debug-endpoints
+
+slow_requests = SlowRequestLog(SLOW_REQUEST_THRESHOLD, SLOW_REQUEST_LOG_SIZE)
+sampling_profiler = SamplingProfiler(PROFILER_INTERVAL)
+
+@app.before_request
+def begin_request_trace():
+    start_trace(request.endpoint or request.path, method=request.method)
+
+@app.teardown_request
+def finish_request_trace(exc=None):
+    slow_requests.record(end_trace())
+
+def debug_endpoint(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if not DEBUG_ENDPOINTS:
+            return jsonify({'error': 'Debug endpoints are disabled'}), 404
+        return f(*args, **kwargs)
+    return wrapper
+
+@app.route('/debug/profiler', methods=['GET'])
+@debug_endpoint
+def get_profiler():
+    """Состояние профайлера; ?format=collapsed — стеки для flame graph"""
+    if request.args.get('format') == 'collapsed':
+        return Response(sampling_profiler.collapsed(), mimetype='text/plain')
+    return jsonify(sampling_profiler.stats())
+
+@app.route('/debug/profiler', methods=['POST'])
+@debug_endpoint
+def control_profiler():
+    """{ action: start | stop | reset, interval }"""
+    data = request.get_json(force=True, silent=True) or {}
+    action = data.get('action')
+    if action == 'start':
+        try:
+            interval = float(data['interval']) if 'interval' in data else None
+        except (TypeError, ValueError):
+            return jsonify({'error': 'interval must be a number'}), 400
+        if interval is not None and interval <= 0:
+            return jsonify({'error': 'interval must be positive'}), 400
+        sampling_profiler.start(interval)
+    elif action == 'stop':
+        sampling_profiler.stop()
+    elif action == 'reset':
+        sampling_profiler.reset()
+    else:
+        return jsonify({'error': 'action must be start, stop or reset'}), 400
+    return jsonify(sampling_profiler.stats())
+
+@app.route('/debug/slow-requests', methods=['GET'])
+@debug_endpoint
+def get_slow_requests():
+    return jsonify({'threshold_ms': round(slow_requests.threshold * 1000, 1),
+                    'requests': slow_requests.entries()})
+
+@app.route('/debug/inference', methods=['GET'])
+@debug_endpoint
+def get_inference_tenants():
+    """Счётчики кадров и очереди на детектор по школам"""
+    return jsonify({
+        'tenants': {sid: dict(st) for sid, st in list(frame_admission.stats.items())},
+        'queued': inference_scheduler.queued()
+    })
+
+# --- API: Метрики ---
+def inference_totals():
+    totals = defaultdict(int)
+    tenants = list(frame_admission.stats.values())
+    for st in tenants:
+        for name, value in list(st.items()):
+            totals[name] += value
+    return dict(totals, tenants=len(tenants), queued=sum(inference_scheduler.queued().values()))
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Внутренние метрики хранилищ"""
+    with janitor_stats_lock:
+        janitor = dict(janitor_stats)
+    with data_lock:
+        sensors = len(data_last_seen)
+    with camera_data_lock:
+        cameras = sum(len(c) for c in camera_data_store.values())
+    with camera_viewers_lock:
+        viewed = len(set(camera_viewers) | set(http_viewer_leases))
+    return jsonify({
+        'frame_store': annotated_frames_store.stats(),
+        'viewed_cameras': viewed,
+        'janitor': janitor,
+        'live_updates': dict(live_stats),
+        'jwt_cache': dict(jwt_cache_stats, size=len(jwt_cache)),
+        'ingest': dict(ingest_stats),
+        # /metrics открыт без авторизации: только суммы, без идентификаторов школ
+        'inference': inference_totals(),
+        'pipeline': frame_pipeline.stats(),
+        'slow_requests': slow_requests.stats(),
+        'profiler': sampling_profiler.stats(),
+        'active': {'sensors': sensors, 'cameras': cameras}
+    })
+
+# --- Очистка неактивных датчиков, камер и школ ---
+JANITOR_INTERVAL = 60               # период проверки, секунд
+SENSOR_TTL = 60 * 60                # датчик без показаний дольше часа удаляется из памяти
+CAMERA_TTL = 60 * 60                # камера без кадров дольше часа удаляется из camera_data_store
+OCCUPANCY_HISTORY_TTL = 90 * 24 * 60 * 60  # история камеры хранится, пока не устареет последний интервал
+
+janitor_stats = {
+    'runs': 0,
+    'sensors_evicted': 0,
+    'cameras_evicted': 0,
+    'schools_evicted': 0,
+    'history_series_evicted': 0,
+    'frames_expired': 0,
+    'last_run': None,
+    'last_duration_ms': None
+}
+janitor_stats_lock = threading.Lock()
+
+def evict_inactive(now=None):
+    """Удаляет из памяти всё, что не обновлялось дольше TTL; возвращает счётчики удалённого"""
+    now = now if now is not None else time.time()
+    started = time.perf_counter()
+    reclaimed = {'sensors': 0, 'cameras': 0, 'schools': 0, 'history_series': 0, 'frames': 0}
+    # Школа может опустеть сразу в нескольких хранилищах — считаем её один раз
+    evicted_schools = set()
+    
+    with data_lock:
+        sensor_deadline = now - SENSOR_TTL
+        for key in [k for k, ts in data_last_seen.items() if ts < sensor_deadline]:
+            school_id, sensor_id = key
+            del data_last_seen[key]
+            sensors = data_store.get(school_id)
+            if sensors is not None and sensors.pop(sensor_id, None) is not None:
+                reclaimed['sensors'] += 1
+        for school_id in [sid for sid, sensors in data_store.items() if not sensors]:
+            del data_store[school_id]
+            evicted_schools.add(school_id)
+    
+    with camera_data_lock:
+        camera_deadline = now - CAMERA_TTL
+        for school_id in list(camera_data_store):
+            cameras = camera_data_store[school_id]
+            for camera_id in [cid for cid, d in cameras.items() if d['timestamp'] < camera_deadline]:
+                del cameras[camera_id]
+                reclaimed['cameras'] += 1
+            if not cameras:
+                del camera_data_store[school_id]
+                evicted_schools.add(school_id)
+    
+    # Пустые записи школ, оставшиеся в defaultdict-хранилищах позиций
+    for store, lock in ((sensor_positions_store, sensor_positions_lock),
+                        (camera_positions_store, camera_positions_lock)):
+        with lock:
+            for school_id in [sid for sid, floors in store.items() if not floors]:
+                del store[school_id]
+                evicted_schools.add(school_id)
+    reclaimed['schools'] = len(evicted_schools)
+    
+    with camera_viewers_lock:
+        lease_deadline = now - VIEWER_LEASE_TTL
+        for key in [k for k, ts in http_viewer_leases.items() if ts < lease_deadline]:
+            del http_viewer_leases[key]
+    
+    purge_jwt_cache(now)
+    frame_admission.prune(CAMERA_TTL)
+    frame_sequencer.expire(CAMERA_TTL)
+    with camera_alerts_lock:
+        for key in [k for k, until in camera_alerts.items() if until <= now]:
+            del camera_alerts[key]
+    reclaimed['history_series'] = occupancy_history.expire(now - OCCUPANCY_HISTORY_TTL)
+    reclaimed['frames'] = annotated_frames_store.expire()
+    
+    with janitor_stats_lock:
+        janitor_stats['runs'] += 1
+        janitor_stats['sensors_evicted'] += reclaimed['sensors']
+        janitor_stats['cameras_evicted'] += reclaimed['cameras']
+        janitor_stats['schools_evicted'] += reclaimed['schools']
+        janitor_stats['history_series_evicted'] += reclaimed['history_series']
+        janitor_stats['frames_expired'] += reclaimed['frames']
+        janitor_stats['last_run'] = int(now)
+        janitor_stats['last_duration_ms'] = round((time.perf_counter() - started) * 1000, 3)
+    
+    if any(reclaimed.values()):
+        logging.info(f'Janitor reclaimed: {reclaimed}')
+    return reclaimed
+
+def janitor_loop():
+    while True:
+        time.sleep(JANITOR_INTERVAL)
+        try:
+            evict_inactive()
+        except Exception as e:
+            logging.error(f'Janitor error: {e}')
+
+threading.Thread(target=janitor_loop, daemon=True).start()
+
+# --- Рассылка изменений датчиков и камер ---
+LIVE_TICK_INTERVAL = 1.0  # секунд между рассылками; изменения за это время объединяются
+
+live_stats = {'ticks': 0, 'updates_sent': 0, 'sensors_sent': 0, 'cameras_sent': 0, 'thumbnails_sent': 0}
+
+def collect_live_updates():
+    """Забирает накопленные изменения: { school_id: { sensors: {...}, cameras: {...}, thumbnails: {...} } }.
+    Миниатюра камеры — последняя за интервал, сколько бы кадров ни пришло."""
+    global dirty_sensors, dirty_cameras, dirty_thumbnails
+    updates = defaultdict(lambda: {'sensors': {}, 'cameras': {}, 'thumbnails': {}})
+    with data_lock:
+        pending, dirty_sensors = dirty_sensors, defaultdict(set)
+        for school_id, sensor_ids in pending.items():
+            sensors = data_store.get(school_id, {})
+            for sensor_id in sensor_ids:
+                readings = sensors.get(sensor_id)
+                if readings:
+                    updates[school_id]['sensors'][sensor_id] = dict(readings[-1])
+    with camera_data_lock:
+        pending, dirty_cameras = dirty_cameras, defaultdict(set)
+        pending_thumbnails, dirty_thumbnails = dirty_thumbnails, defaultdict(set)
+        for school_id, camera_ids in pending.items():
+            cameras = camera_data_store.get(school_id, {})
+            for camera_id in camera_ids:
+                if camera_id in cameras:
+                    updates[school_id]['cameras'][camera_id] = dict(cameras[camera_id])
+    for school_id, camera_ids in pending_thumbnails.items():
+        for camera_id in camera_ids:
+            frame = annotated_frames_store.get_jpeg(school_id, camera_id, 'thumbnail')
+            if frame is not None and frame[1]['rendition'] == 'thumbnail':
+                updates[school_id]['thumbnails'][camera_id] = frame[0]
+    return updates
+
+def live_update_loop():
+    """Раз в LIVE_TICK_INTERVAL отправляет каждой школе только изменившиеся датчики и камеры"""
+    while True:
+        time.sleep(LIVE_TICK_INTERVAL)
+        try:
+            updates = collect_live_updates()
+            for school_id, delta in updates.items():
+                socketio.emit('live_update', {
+                    'school_id': school_id,
+                    'sensors': delta['sensors'],
+                    'cameras': delta['cameras'],
+                    'thumbnails': delta['thumbnails'],
+                    'timestamp': int(time.time())
+                }, to=school_room(school_id), namespace='/')
+                live_stats['sensors_sent'] += len(delta['sensors'])
+                live_stats['cameras_sent'] += len(delta['cameras'])
+                live_stats['thumbnails_sent'] += len(delta['thumbnails'])
+            live_stats['updates_sent'] += len(updates)
+            live_stats['ticks'] += 1
+        except Exception as e:
+            logging.error(f'Live update error: {e}')
+
+threading.Thread(target=live_update_loop, daemon=True).start()
+
 # --- WebSocket для реального времени ---
+# Аутентифицированные WebSocket-соединения: sid -> school_id (токен проверяется один раз при подключении)
+socket_sessions = {}
+socket_sessions_lock = threading.Lock()
+
+def socket_school_id():
+    with socket_sessions_lock:
+        return socket_sessions.get(request.sid)
+
+def authenticate_socket(auth):
+    """Проверяет токен из auth/query один раз при подключении; False — отклонить соединение"""
+    token = (auth or {}).get('token') or request.args.get('token')
+    if not token:
+        logging.warning(f'Client {request.sid} rejected: no token')
+        return False
+    try:
+        school_id = verify_token(token)
+    except Exception as e:
+        logging.warning(f'Client {request.sid} rejected: {e}')
+        return False
+    with socket_sessions_lock:
+        socket_sessions[request.sid] = school_id
+    logging.info(f'Client connected: {request.sid} ({school_id})')
+    return True
+
 @socketio.on('connect')
-def handle_connect():
-    logging.info(f'Client connected: {request.sid}')
+def handle_connect(auth=None):
+    if not authenticate_socket(auth):
+        return False
 
 @socketio.on('disconnect')
 def handle_disconnect():
+    with socket_sessions_lock:
+        socket_sessions.pop(request.sid, None)
+    with camera_viewers_lock:
+        for key in viewer_sessions.pop(request.sid, ()):
+            camera_viewers[key].discard(request.sid)
+            if not camera_viewers[key]:
+                del camera_viewers[key]
     logging.info(f'Client disconnected: {request.sid}')
 
 @socketio.on('subscribe')
-def handle_subscribe(data):
-    school_id = data.get('school_id')
+def handle_subscribe(data=None):
+    # Школа берётся из токена соединения, а не из данных клиента
+    school_id = socket_school_id()
+    if school_id is None:
+        return
+    join_room(school_room(school_id))
     logging.info(f'Client {request.sid} subscribed to {school_id}')
 
+@socketio.on('watch_camera')
+def handle_watch_camera(data):
+    """Клиент открыл просмотр камеры — сервер начинает кодировать и присылать полные кадры"""
+    school_id = socket_school_id()
+    camera_id = data.get('camera_id')
+    if not school_id or not camera_id:
+        return
+    key = (school_id, camera_id)
+    join_room(camera_room(school_id, camera_id))
+    with camera_viewers_lock:
+        camera_viewers[key].add(request.sid)
+        viewer_sessions[request.sid].add(key)
+
+@socketio.on('unwatch_camera')
+def handle_unwatch_camera(data):
+    school_id = socket_school_id()
+    camera_id = data.get('camera_id')
+    key = (school_id, camera_id)
+    leave_room(camera_room(school_id, camera_id))
+    with camera_viewers_lock:
+        viewers = camera_viewers.get(key)
+        if viewers is not None:
+            viewers.discard(request.sid)
+            if not viewers:
+                del camera_viewers[key]
+        sessions = viewer_sessions.get(request.sid)
+        if sessions is not None:
+            sessions.discard(key)
+            if not sessions:
+                del viewer_sessions[request.sid]
+
+# --- WebSocket-канал приёма кадров от камер ---
+# Камера подключается к /ingest один раз (токен проверяется при подключении) и шлёт
+# события 'frame' { camera_id, seq, frame: <JPEG-байты>, annotated }; результат приходит
+# событием 'frame_result' { camera_id, seq, ... } по тому же соединению.
+INGEST_NAMESPACE = '/ingest'
+ingest_stats = {'connections': 0, 'frames': 0, 'errors': 0}
+
+@socketio.on('connect', namespace=INGEST_NAMESPACE)
+def handle_ingest_connect(auth=None):
+    if not authenticate_socket(auth):
+        return False
+    ingest_stats['connections'] += 1
+
+@socketio.on('disconnect', namespace=INGEST_NAMESPACE)
+def handle_ingest_disconnect():
+    with socket_sessions_lock:
+        socket_sessions.pop(request.sid, None)
+    ingest_stats['connections'] -= 1
+
+@socketio.on('frame', namespace=INGEST_NAMESPACE)
+def handle_ingest_frame(data):
+    school_id = socket_school_id()
+    camera_id = data.get('camera_id')
+    seq = data.get('seq')
+    frame_bytes = data.get('frame')
+    
+    def reply(payload, error=False):
+        if error:
+            ingest_stats['errors'] += 1
+        emit('frame_result', dict(payload, camera_id=camera_id, seq=seq))
+    
+    if school_id is None:
+        return reply({'error': 'Not authenticated'}, error=True)
+    if not camera_id or not isinstance(frame_bytes, (bytes, bytearray)):
+        return reply({'error': 'camera_id and binary frame required'}, error=True)
+    
+    admitted, retry_after = frame_admission.admit(school_id, camera_id)
+    if not admitted:
+        return reply({'error': 'Frame rate quota exceeded', 'retry_after': round(retry_after, 3)}, error=True)
+    
+    ingest_stats['frames'] += 1
+    # Обработчики Socket.IO не проходят before_request — трасса кадра открывается здесь
+    start_trace('ingest.frame', method='WS', school_id=school_id)
+    try:
+        annotate = bool(data.get('annotated', True))
+        result = process_frame(school_id, camera_id, bytes(frame_bytes), annotate,
+                               annotate and bool(data.get('return_frame')))
+        with span('reply'):
+            reply(result)
+    except InvalidFrame:
+        reply({'error': 'Invalid frame data'}, error=True)
+    except (JobDropped, PipelineBusy) as e:
+        reply({'error': 'Frame dropped', 'details': str(e)}, error=True)
+    except Exception as e:
+        logging.error(f'Error processing ingest frame: {e}')
+        reply({'error': str(e)}, error=True)
+    finally:
+        slow_requests.record(end_trace())
+
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Safe School server')
+    parser.add_argument('--capture', default=None, help='append ingested sensor readings and frames to this file')
+    parser.add_argument('--debug-endpoints', action='store_true', help='enable /debug/profiler and /debug/slow-requests')
+    parser.add_argument('--profile', default=None, metavar='FILE',
+                        help='run the sampling profiler from startup and write collapsed stacks to FILE on exit')
+    parser.add_argument('--slow-request-ms', type=float, default=None, help='slow request threshold, ms')
+    args = parser.parse_args()
+    if args.capture:
+        capture_writer = CaptureWriter(args.capture)
+    DEBUG_ENDPOINTS = args.debug_endpoints
+    if args.slow_request_ms is not None:
+        slow_requests.threshold = args.slow_request_ms / 1000
+    if args.profile:
+        sampling_profiler.start()
+    
     logging.info('Starting Flask server with SocketIO...')
-    socketio.run(app, host='0.0.0.0', port=5000, debug=False, allow_unsafe_werkzeug=True)
+    try:
+        socketio.run(app, host='0.0.0.0', port=5000, debug=False, allow_unsafe_werkzeug=True)
+    finally:
+        if args.profile:
+            sampling_profiler.stop()
+            sampling_profiler.dump(args.profile)
+            logging.info(f'Profile written to {args.profile}')
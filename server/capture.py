@@ -0,0 +1,373 @@
+"""
+Запись и воспроизведение входящего трафика сервера.
+
+Формат файла записи (append-only, little-endian):
+    8 байт заголовка MAGIC, затем записи подряд:
+    crc32(I) kind(B) timestamp(d) len(school_id)(H) len(source_id)(H) len(payload)(I)
+    school_id, source_id, payload
+Рядом лежит индекс <file>.idx из записей фиксированной длины (offset, timestamp, kind),
+по которому можно быстро посчитать записи и перейти к нужному моменту времени.
+
+Запуск воспроизведения:
+    python capture.py replay day.sscap --speed 1      # в реальном времени
+    python capture.py replay day.sscap --speed 10     # в 10 раз быстрее
+    python capture.py replay day.sscap --speed max    # без пауз
+    python capture.py info day.sscap
+"""
+import argparse
+import base64
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+MAGIC = b'SSCAP\x00\x01\x00'
+
+KIND_SENSOR = 1           # показание датчика -> POST /sensor-data
+KIND_FRAME = 2            # JPEG-кадр -> POST /video-frame
+KIND_FRAME_ANNOTATED = 3  # JPEG-кадр -> POST /video-frame-annotated
+
+FRAME_ENDPOINTS = {KIND_FRAME: '/video-frame', KIND_FRAME_ANNOTATED: '/video-frame-annotated'}
+
+_RECORD_HEADER = struct.Struct('<IBdHHI')
+_INDEX_ENTRY = struct.Struct('<QdB')
+_SENSOR_PAYLOAD = struct.Struct('<dd')
+
+Record = namedtuple('Record', 'kind timestamp school_id source_id payload')
+
+
+def index_path(path):
+    return path + '.idx'
+
+
+def _scan(f):
+    """Проходит по заголовкам записей, возвращает [(offset, timestamp, kind)] и конец последней целой записи"""
+    entries = []
+    f.seek(len(MAGIC))
+    offset = len(MAGIC)
+    while True:
+        header = f.read(_RECORD_HEADER.size)
+        if len(header) < _RECORD_HEADER.size:
+            break
+        crc, kind, ts, school_len, source_len, payload_len = _RECORD_HEADER.unpack(header)
+        body = f.read(school_len + source_len + payload_len)
+        if len(body) < school_len + source_len + payload_len:
+            break
+        if zlib.crc32(header[4:] + body) != crc:
+            break
+        entries.append((offset, ts, kind))
+        offset = f.tell()
+    return entries, offset
+
+
+class CaptureWriter:
+    """Потокобезопасная запись трафика в конец файла"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.records = 0
+        self.bytes = 0
+        exists = os.path.exists(path) and os.path.getsize(path) >= len(MAGIC)
+        self._file = open(path, 'r+b' if exists else 'wb')
+        if exists:
+            if self._file.read(len(MAGIC)) != MAGIC:
+                self._file.close()
+                raise ValueError(f'{path} is not a capture file')
+            # Обрезаем недописанный хвост (например, после падения) и пересобираем индекс
+            entries, end = _scan(self._file)
+            self._file.truncate(end)
+            self._file.seek(end)
+            with open(index_path(path), 'wb') as idx:
+                for entry in entries:
+                    idx.write(_INDEX_ENTRY.pack(*entry))
+            self.records = len(entries)
+        else:
+            self._file.write(MAGIC)
+        self._index = open(index_path(path), 'ab')
+        logging.info(f'Capture: recording to {path} ({self.records} existing records)')
+
+    def _append(self, kind, school_id, source_id, payload, timestamp=None):
+        ts = timestamp if timestamp is not None else time.time()
+        school = school_id.encode('utf-8')
+        source = source_id.encode('utf-8')
+        rest = _RECORD_HEADER.pack(0, kind, ts, len(school), len(source), len(payload))[4:]
+        crc = zlib.crc32(rest + school + source + payload)
+        with self._lock:
+            if self._file is None:
+                return
+            offset = self._file.tell()
+            self._file.write(struct.pack('<I', crc) + rest + school + source + payload)
+            self._file.flush()
+            self._index.write(_INDEX_ENTRY.pack(offset, ts, kind))
+            self._index.flush()
+            self.records += 1
+            self.bytes += _RECORD_HEADER.size + len(school) + len(source) + len(payload)
+
+    def record_sensor(self, school_id, sensor_id, value, reading_timestamp):
+        self._append(KIND_SENSOR, school_id, str(sensor_id),
+                     _SENSOR_PAYLOAD.pack(float(value), float(reading_timestamp)))
+
+    def record_frame(self, school_id, camera_id, jpeg_bytes, annotated=False):
+        self._append(KIND_FRAME_ANNOTATED if annotated else KIND_FRAME, school_id, str(camera_id), bytes(jpeg_bytes))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._index.close()
+                self._file = None
+
+
+class CaptureReader:
+    """Чтение файла записи; индекс используется, если он есть и совпадает с файлом"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{path} is not a capture file')
+            self.entries = self._load_index(f)
+            if self.entries is None:
+                self.entries, _ = _scan(f)
+
+    def _load_index(self, f):
+        """Записи индекса или None, если индекса нет или он не доходит до конца файла"""
+        try:
+            with open(index_path(self.path), 'rb') as idx:
+                raw = idx.read()
+        except OSError:
+            return None
+        usable = len(raw) - len(raw) % _INDEX_ENTRY.size
+        entries = [_INDEX_ENTRY.unpack_from(raw, i) for i in range(0, usable, _INDEX_ENTRY.size)]
+        size = os.path.getsize(self.path)
+        end = len(MAGIC)
+        if entries:
+            # Индекс пишется после данных: если последняя запись индекса не кончается
+            # в конце файла, часть записей в индекс не попала — сканируем файл
+            offset = entries[-1][0]
+            f.seek(offset)
+            header = f.read(_RECORD_HEADER.size)
+            if len(header) < _RECORD_HEADER.size:
+                return None
+            _, _, _, school_len, source_len, payload_len = _RECORD_HEADER.unpack(header)
+            end = offset + _RECORD_HEADER.size + school_len + source_len + payload_len
+        if end != size:
+            return None
+        return entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def duration(self):
+        return self.entries[-1][1] - self.entries[0][1] if self.entries else 0.0
+
+    def counts(self):
+        result = {}
+        for _, _, kind in self.entries:
+            result[kind] = result.get(kind, 0) + 1
+        return result
+
+    def first_index(self, timestamp):
+        """Номер первой записи с временем >= timestamp (бинарный поиск по индексу)"""
+        lo, hi = 0, len(self.entries)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entries[mid][1] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def records(self, start=None):
+        first = self.first_index(start) if start is not None else 0
+        with open(self.path, 'rb') as f:
+            for offset, _, _ in self.entries[first:]:
+                f.seek(offset)
+                _, kind, ts, school_len, source_len, payload_len = _RECORD_HEADER.unpack(f.read(_RECORD_HEADER.size))
+                school_id = f.read(school_len).decode('utf-8')
+                source_id = f.read(source_len).decode('utf-8')
+                yield Record(kind, ts, school_id, source_id, f.read(payload_len))
+
+    def __iter__(self):
+        return self.records()
+
+
+# --- Воспроизведение ---
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def replay(path, server_url, speed=1.0, workers=8, start=None, limit=None, token=None, secret=None):
+    """Отправляет записанный трафик на сервер; speed=None — максимальная скорость.
+    Токены: token — один для всех записей, secret — подписываются локально
+    для школы каждой записи, иначе запрашиваются через /get-token (только
+    для зарегистрированных школ). Возвращает статистику по задержкам и
+    пропускной способности."""
+    import requests
+
+    reader = CaptureReader(path)
+    local = threading.local()
+    tokens = {}
+    tokens_lock = threading.Lock()
+    latencies = []
+    lags = []
+    errors = {'count': 0}
+    stats_lock = threading.Lock()
+    # Ограничение записей в очереди пула: иначе при --speed max (или медленном
+    # сервере) в памяти оказываются все кадры файла
+    in_flight = threading.BoundedSemaphore(workers * 2)
+
+    def session():
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        return local.session
+
+    def token_for(school_id):
+        if token is not None:
+            return token
+        with tokens_lock:
+            school_token = tokens.get(school_id)
+        if school_token is None:
+            if secret is not None:
+                import jwt
+                payload = {'school_id': school_id, 'exp': int(time.time()) + 60*60*24}
+                school_token = jwt.encode(payload, secret, algorithm='HS256')
+            else:
+                resp = session().get(f'{server_url}/get-token/{school_id}', timeout=5)
+                resp.raise_for_status()
+                school_token = resp.json()['token']
+            with tokens_lock:
+                tokens[school_id] = school_token
+        return school_token
+
+    def send(record, time_shift, due):
+        try:
+            headers = {'Authorization': f'Bearer {token_for(record.school_id)}'}
+            if record.kind == KIND_SENSOR:
+                value, reading_ts = _SENSOR_PAYLOAD.unpack(record.payload)
+                url = f'{server_url}/sensor-data'
+                body = {'sensor_id': record.source_id, 'temperature': value,
+                        'timestamp': int(reading_ts + time_shift)}
+            else:
+                url = server_url + FRAME_ENDPOINTS[record.kind]
+                body = {'camera_id': record.source_id,
+                        'frame': base64.b64encode(record.payload).decode('ascii')}
+            t0 = time.perf_counter()
+            resp = session().post(url, json=body, headers=headers, timeout=30)
+            elapsed = time.perf_counter() - t0
+            with stats_lock:
+                latencies.append(elapsed)
+                lags.append(t0 - due)
+                if not resp.ok:
+                    errors['count'] += 1
+        except Exception as e:
+            logging.error(f'Replay error: {e}')
+            with stats_lock:
+                errors['count'] += 1
+        finally:
+            in_flight.release()
+
+    sent = 0
+    wall_start = time.time()
+    perf_start = time.perf_counter()
+    first_ts = None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for record in reader.records(start):
+            if limit is not None and sent >= limit:
+                break
+            if first_ts is None:
+                first_ts = record.timestamp
+            # due — момент, когда запись должна уйти по расписанию записи
+            # (при speed=None — момент чтения из файла)
+            if speed:
+                due = perf_start + (record.timestamp - first_ts) / speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                due = time.perf_counter()
+            in_flight.acquire()
+            pool.submit(send, record, wall_start - first_ts, due)
+            sent += 1
+    total = time.perf_counter() - perf_start
+
+    latencies.sort()
+    lags.sort()
+    return {
+        'file': path,
+        'speed': speed or 'max',
+        'requests': sent,
+        'errors': errors['count'],
+        'elapsed_s': round(total, 3),
+        'throughput_rps': round(sent / total, 2) if total > 0 else None,
+        'latency_ms': {
+            'p50': round(_percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+            'p95': round(_percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+            'p99': round(_percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+            'max': round(latencies[-1] * 1000, 2) if latencies else None,
+        },
+        # Отставание отправки от расписания записи: большие значения значат, что
+        # замер упёрся в сервер или --workers, а не воспроизводит исходный темп
+        'lag_ms': {
+            'p50': round(_percentile(lags, 0.50) * 1000, 2) if lags else None,
+            'p95': round(_percentile(lags, 0.95) * 1000, 2) if lags else None,
+            'max': round(lags[-1] * 1000, 2) if lags else None,
+        },
+    }
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    parser = argparse.ArgumentParser(description='Safe School traffic capture tool')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    info_p = sub.add_parser('info', help='Show capture file summary')
+    info_p.add_argument('file')
+
+    replay_p = sub.add_parser('replay', help='Replay capture against a server')
+    replay_p.add_argument('file')
+    replay_p.add_argument('--server', default='http://localhost:5000')
+    replay_p.add_argument('--speed', default='1', help='playback speed multiplier or "max"')
+    replay_p.add_argument('--workers', type=int, default=8)
+    replay_p.add_argument('--start', type=float, default=None, help='unix time to start from')
+    replay_p.add_argument('--limit', type=int, default=None, help='send at most N records')
+    replay_p.add_argument('--json', dest='json_out', default=None, help='write results to this file')
+    auth = replay_p.add_mutually_exclusive_group()
+    auth.add_argument('--token', default=None, help='send every record with this JWT (as its school)')
+    auth.add_argument('--secret', default=None, help='sign per-school JWTs with the server SECRET_KEY '
+                                                     'instead of asking /get-token')
+
+    args = parser.parse_args()
+    if args.command == 'info':
+        reader = CaptureReader(args.file)
+        counts = reader.counts()
+        print(json.dumps({
+            'records': len(reader),
+            'duration_s': round(reader.duration(), 3),
+            'sensor_readings': counts.get(KIND_SENSOR, 0),
+            'frames': counts.get(KIND_FRAME, 0),
+            'annotated_frames': counts.get(KIND_FRAME_ANNOTATED, 0),
+        }, indent=2))
+        return
+
+    speed = None if args.speed == 'max' else float(args.speed)
+    if speed is not None and speed <= 0:
+        parser.error('--speed must be positive or "max"')
+    result = replay(args.file, args.server.rstrip('/'), speed, args.workers, args.start, args.limit,
+                    token=args.token, secret=args.secret)
+    print(json.dumps(result, indent=2))
+    if args.json_out:
+        with open(args.json_out, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
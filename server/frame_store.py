@@ -0,0 +1,153 @@
+"""
+Хранилище последних кадров камер с ограничением по памяти.
+Для каждой камеры хранятся JPEG-байты в нескольких разрешениях (миниатюра для
+списка камер и полный кадр, если камеру кто-то смотрит); base64 строится только
+по запросу (для старых клиентов) и кэшируется до прихода следующего кадра.
+При превышении общего бюджета вытесняются камеры, которые дольше всех не
+присылали кадров; камеры, молчащие дольше ttl секунд, удаляются.
+"""
+import base64
+import threading
+import time
+from collections import OrderedDict
+
+
+class FrameStore:
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=300):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # (school_id, camera_id) -> entry; порядок — от давно обновлённых к свежим
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evicted_lru = 0
+        self.evicted_expired = 0
+        self.b64_encoded = 0
+
+    @staticmethod
+    def _size(entry):
+        return (sum(len(jpeg) for jpeg in entry['renditions'].values())
+                + sum(len(b64) for b64 in entry['b64'].values()))
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= self._size(entry)
+
+    def _expire(self, now):
+        deadline = now - self.ttl
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry['received_at'] >= deadline:
+                break
+            self._drop(key)
+            self.evicted_expired += 1
+
+    def _enforce_budget(self, keep=None):
+        while self._bytes > self.max_bytes and self._entries:
+            key = next(iter(self._entries))
+            if key == keep:
+                # Единственный кадр больше всего бюджета — храним только его
+                if len(self._entries) == 1:
+                    break
+                self._entries.move_to_end(key)
+                continue
+            self._drop(key)
+            self.evicted_lru += 1
+
+    def put(self, school_id, camera_id, renditions, count, boxes, timestamp=None):
+        """renditions: { 'full': bytes, 'thumbnail': bytes } — любые из разрешений"""
+        now = time.time()
+        key = (school_id, camera_id)
+        entry = {
+            'renditions': {name: bytes(jpeg) for name, jpeg in renditions.items() if jpeg is not None},
+            'b64': {},
+            'count': count,
+            'boxes': boxes,
+            'timestamp': int(timestamp if timestamp is not None else now),
+            'received_at': now,
+        }
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = entry
+            self._bytes += self._size(entry)
+            self._expire(now)
+            self._enforce_budget(keep=key)
+
+    def _get(self, school_id, camera_id):
+        entry = self._entries.get((school_id, camera_id))
+        if entry is None:
+            return None
+        if entry['received_at'] < time.time() - self.ttl:
+            self._drop((school_id, camera_id))
+            self.evicted_expired += 1
+            return None
+        return entry
+
+    @staticmethod
+    def _pick(entry, rendition):
+        """Запрошенное разрешение, а если его нет — любое имеющееся"""
+        if rendition in entry['renditions']:
+            return rendition
+        return next(iter(entry['renditions']), None)
+
+    def get_jpeg(self, school_id, camera_id, rendition='full'):
+        """(jpeg_bytes, метаданные) или None"""
+        with self._lock:
+            entry = self._get(school_id, camera_id)
+            name = self._pick(entry, rendition) if entry is not None else None
+            if name is None:
+                return None
+            return entry['renditions'][name], {
+                'count': entry['count'],
+                'boxes': entry['boxes'],
+                'timestamp': entry['timestamp'],
+                'rendition': name,
+            }
+
+    def get_legacy(self, school_id, camera_id, rendition='full'):
+        """Кадр в старом формате { frame: base64, count, boxes, timestamp, rendition }"""
+        with self._lock:
+            entry = self._get(school_id, camera_id)
+            name = self._pick(entry, rendition) if entry is not None else None
+            if name is None:
+                return None
+            frame_b64 = entry['b64'].get(name)
+            if frame_b64 is None:
+                frame_b64 = entry['b64'][name] = base64.b64encode(entry['renditions'][name]).decode('ascii')
+                self._bytes += len(frame_b64)
+                self.b64_encoded += 1
+                self._enforce_budget(keep=(school_id, camera_id))
+            return {
+                'frame': frame_b64,
+                'count': entry['count'],
+                'boxes': entry['boxes'],
+                'timestamp': entry['timestamp'],
+                'rendition': name,
+            }
+
+    def expire(self):
+        """Удаляет камеры, молчащие дольше ttl; возвращает количество удалённых"""
+        with self._lock:
+            before = self.evicted_expired
+            self._expire(time.time())
+            return self.evicted_expired - before
+
+    def remove_school(self, school_id):
+        with self._lock:
+            keys = [key for key in self._entries if key[0] == school_id]
+            for key in keys:
+                self._drop(key)
+            return len(keys)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'cameras': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'evicted_lru': self.evicted_lru,
+                'evicted_expired': self.evicted_expired,
+                'b64_encoded': self.b64_encoded,
+            }
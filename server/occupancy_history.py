@@ -0,0 +1,166 @@
+"""
+История заполненности помещений по камерам.
+Хранит для каждой камеры временной ряд количества людей с автоматическим
+укрупнением интервалов: 1 с -> 1 мин -> 15 мин -> 1 ч (min/max/avg в каждом
+интервале). Память на камеру ограничена ёмкостью кольцевых буферов.
+"""
+import threading
+import time
+from array import array
+
+# (ширина интервала в секундах, сколько интервалов хранить)
+DEFAULT_LEVELS = (
+    (1, 600),          # 10 минут посекундно
+    (60, 24 * 60),     # сутки поминутно
+    (900, 7 * 96),     # неделя по 15 минут
+    (3600, 90 * 24),   # 90 дней по часу
+)
+
+
+class _Level:
+    """Кольцевой буфер интервалов одной ширины (компактные массивы вместо dict)"""
+    __slots__ = ('width', 'capacity', 'starts', 'mins', 'maxs', 'sums', 'counts', 'head')
+
+    def __init__(self, width, capacity):
+        self.width = width
+        self.capacity = capacity
+        self.starts = array('q')
+        self.mins = array('l')
+        self.maxs = array('l')
+        self.sums = array('d')
+        self.counts = array('l')
+        self.head = 0  # физический индекс самого старого интервала
+
+    def _pos(self, i):
+        return (self.head + i) % self.capacity
+
+    def add(self, ts, value):
+        start = ts - ts % self.width
+        size = len(self.starts)
+        if size:
+            last = self._pos(size - 1)
+            last_start = self.starts[last]
+            if start == last_start:
+                if value < self.mins[last]:
+                    self.mins[last] = value
+                if value > self.maxs[last]:
+                    self.maxs[last] = value
+                self.sums[last] += value
+                self.counts[last] += 1
+                return
+            if start < last_start:
+                # Запоздавшие замеры в уже закрытые интервалы не переписываем
+                return
+        if size < self.capacity:
+            self.starts.append(start)
+            self.mins.append(value)
+            self.maxs.append(value)
+            self.sums.append(value)
+            self.counts.append(1)
+        else:
+            pos = self.head
+            self.starts[pos] = start
+            self.mins[pos] = value
+            self.maxs[pos] = value
+            self.sums[pos] = value
+            self.counts[pos] = 1
+            self.head = (self.head + 1) % self.capacity
+
+    def _bisect(self, ts):
+        """Логический индекс первого интервала с началом >= ts"""
+        lo, hi = 0, len(self.starts)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.starts[self._pos(mid)] < ts:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def newest(self):
+        size = len(self.starts)
+        return self.starts[self._pos(size - 1)] if size else None
+
+    def range(self, start, end):
+        """Интервалы, пересекающиеся с [start, end]"""
+        points = []
+        for i in range(self._bisect(start - self.width + 1), len(self.starts)):
+            pos = self._pos(i)
+            bucket_start = self.starts[pos]
+            if bucket_start > end:
+                break
+            points.append({
+                'timestamp': bucket_start,
+                'min': self.mins[pos],
+                'max': self.maxs[pos],
+                'avg': round(self.sums[pos] / self.counts[pos], 2),
+            })
+        return points
+
+
+class OccupancyHistory:
+    """Потокобезопасное хранилище истории: school_id -> camera_id -> [_Level, ...]"""
+
+    def __init__(self, levels=DEFAULT_LEVELS):
+        self.levels = tuple(levels)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def record(self, school_id, camera_id, count, timestamp=None):
+        ts = int(timestamp if timestamp is not None else time.time())
+        value = int(count)
+        with self._lock:
+            cameras = self._series.setdefault(school_id, {})
+            series = cameras.get(camera_id)
+            if series is None:
+                series = cameras[camera_id] = [_Level(w, c) for w, c in self.levels]
+            for level in series:
+                level.add(ts, value)
+
+    def cameras(self, school_id):
+        with self._lock:
+            return list(self._series.get(school_id, {}))
+
+    def remove_school(self, school_id):
+        """Удаляет всю историю школы (как FrameStore.remove_school); True, если она была"""
+        with self._lock:
+            return self._series.pop(school_id, None) is not None
+
+    def expire(self, before):
+        """Удаляет камеры без замеров начиная с before; возвращает количество удалённых"""
+        removed = 0
+        with self._lock:
+            for school_id in list(self._series):
+                cameras = self._series[school_id]
+                for camera_id in [cid for cid, series in cameras.items() if series[0].newest() < before]:
+                    del cameras[camera_id]
+                    removed += 1
+                if not cameras:
+                    del self._series[school_id]
+        return removed
+
+    def pick_resolution(self, start, end, max_points, now=None):
+        """Самая мелкая ширина интервала, которая ещё хранит start и даёт не больше max_points точек"""
+        now = now if now is not None else time.time()
+        for width, capacity in self.levels:
+            if now - width * capacity > start:
+                continue
+            if (end - start) / width <= max_points:
+                return width
+        return self.levels[-1][0]
+
+    def query(self, school_id, camera_ids, start, end, resolution=None, max_points=500):
+        """Возвращает (resolution, {camera_id: [точки]}) без обхода сырых замеров"""
+        if resolution is None:
+            resolution = self.pick_resolution(start, end, max_points)
+        widths = [w for w, _ in self.levels]
+        if resolution not in widths:
+            raise ValueError(f'resolution must be one of {widths}')
+        idx = widths.index(resolution)
+        result = {}
+        with self._lock:
+            cameras = self._series.get(school_id, {})
+            for camera_id in camera_ids:
+                series = cameras.get(camera_id)
+                result[camera_id] = series[idx].range(start, end) if series else []
+        return resolution, result
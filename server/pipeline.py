@@ -0,0 +1,273 @@
+"""
+Конвейер обработки кадров: последовательность стадий, у каждой — своя
+ограниченная очередь и свои рабочие потоки, поэтому разные кадры одновременно
+находятся на разных стадиях (декодирование следующего кадра идёт, пока
+детектор занят предыдущим). Заполненная очередь стадии притормаживает
+предыдущую стадию, а при переполнении первой очереди кадр отклоняется.
+"""
+import logging
+import queue
+import threading
+import time
+
+from profiler import use_trace
+from scheduler import JobDropped
+
+
+class PipelineBusy(Exception):
+    pass
+
+
+class FrameContext:
+    """Состояние одного кадра на всём пути по конвейеру"""
+
+    def __init__(self, school_id, camera_id, frame_bytes, options=None, trace=None, seq=None):
+        self.school_id = school_id
+        self.camera_id = camera_id
+        self.frame_bytes = frame_bytes
+        self.seq = seq          # номер кадра камеры (FrameSequencer), в порядке поступления
+        self.options = options or {}
+        self.data = {}          # промежуточные результаты стадий
+        self.result = None
+        self.error = None
+        self.trace = trace      # profiler.Trace: ожидание в очереди и работа каждой стадии
+        self.enqueued_at = None
+        self.cancelled = False
+        self.job = None         # задача планировщика на стадии детекции
+        self._done = threading.Event()
+
+    def finish(self, error=None):
+        if error is not None:
+            self.error = error
+        self._done.set()
+
+    def cancel(self):
+        self.cancelled = True
+        if self.job is not None:
+            self.job.cancelled = True
+
+    def wait(self, timeout=None):
+        """Результат последней стадии; исключение стадии, JobDropped при тайм-ауте"""
+        if not self._done.wait(timeout):
+            self.cancel()
+            raise JobDropped('frame processing timed out')
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class FrameSequencer:
+    """Порядок кадров одной камеры. На стадиях с несколькими потоками кадры могут
+    обгонять друг друга; стадия, которой важен порядок, принимает только кадры
+    новее уже принятого и отбрасывает устаревшие."""
+
+    def __init__(self):
+        self._issued = {}      # key -> (последний выданный номер, время выдачи)
+        self._accepted = {}    # (стадия, key) -> последний принятый номер
+        self._lock = threading.Lock()
+
+    def next(self, key):
+        with self._lock:
+            seq = self._issued.get(key, (0, 0))[0] + 1
+            self._issued[key] = (seq, time.monotonic())
+            return seq
+
+    def accept(self, stage, key, seq):
+        """True, если кадр seq новее всех, уже принятых стадией stage для key"""
+        if seq is None:
+            return True
+        with self._lock:
+            if seq <= self._accepted.get((stage, key), 0):
+                return False
+            self._accepted[(stage, key)] = seq
+            return True
+
+    def expire(self, idle_seconds):
+        """Забывает камеры без кадров дольше idle_seconds; возвращает их количество"""
+        deadline = time.monotonic() - idle_seconds
+        with self._lock:
+            stale = [key for key, (_, issued_at) in self._issued.items() if issued_at < deadline]
+            for key in stale:
+                del self._issued[key]
+            stale_set = set(stale)
+            for accepted_key in [k for k in self._accepted if k[1] in stale_set]:
+                del self._accepted[accepted_key]
+            return len(stale)
+
+
+class Stage:
+    """Стадия с очередью на queue_size кадров и workers потоками.
+    fn(ctx) изменяет ctx; when(ctx) -> False пропускает стадию для этого кадра."""
+
+    def __init__(self, name, fn, workers=1, queue_size=16, when=None):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.queue_size = queue_size
+        self.when = when
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._advance = None
+        self.processed = 0
+        self.busy_seconds = 0.0
+        self._stats_lock = threading.Lock()  # счётчики обновляют все потоки стадии
+
+    def applies(self, ctx):
+        return self.when is None or self.when(ctx)
+
+    def start(self, advance):
+        self._advance = advance
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f'pipeline-{self.name}-{i}', daemon=True).start()
+
+    def put(self, ctx, block=True, timeout=None):
+        ctx.enqueued_at = time.perf_counter()
+        self._queue.put(ctx, block=block, timeout=timeout)
+
+    def run(self, ctx):
+        started = time.perf_counter()
+        trace = ctx.trace
+        if trace is not None:
+            trace.add(f'{self.name}.queue', started - ctx.enqueued_at)
+        try:
+            with use_trace(trace):
+                self.fn(ctx)
+        except Exception as e:
+            ctx.error = e
+        elapsed = time.perf_counter() - started
+        if trace is not None:
+            trace.add(self.name, elapsed)
+        with self._stats_lock:
+            self.processed += 1
+            self.busy_seconds += elapsed
+
+    def _worker(self):
+        while True:
+            ctx = self._queue.get()
+            if not ctx.cancelled:
+                self.run(ctx)
+            self._advance(ctx, self)
+
+    def stats(self):
+        with self._stats_lock:
+            return {'queued': self._queue.qsize(), 'processed': self.processed,
+                    'busy_ms': round(self.busy_seconds * 1000, 1)}
+
+
+class SchedulerStage(Stage):
+    """Стадия, очередь которой — FairScheduler: кадры школ чередуются взвешенным round-robin"""
+
+    def __init__(self, name, fn, scheduler, priority=None):
+        super().__init__(name, fn, workers=0, queue_size=0)
+        self.scheduler = scheduler
+        self.priority = priority
+
+    def start(self, advance):
+        self._advance = advance
+
+    def put(self, ctx, block=True, timeout=None):
+        ctx.enqueued_at = time.perf_counter()
+        ctx.job = self.scheduler.submit(
+            ctx.school_id, ctx.camera_id, self._execute, ctx,
+            priority=bool(self.priority and self.priority(ctx)),
+            callback=lambda job: self._on_done(ctx, job))
+
+    def _execute(self, ctx):
+        # Ошибку стадии пробрасываем планировщику, чтобы она попала в счётчик failed
+        self.run(ctx)
+        if ctx.error is not None:
+            raise ctx.error
+
+    def _on_done(self, ctx, job):
+        if job.dropped:
+            ctx.error = JobDropped('frame dropped: school queue is full')
+        self._advance(ctx, self)
+
+    def stats(self):
+        queued = self.scheduler.queued()
+        with self._stats_lock:
+            return {'queued': sum(queued.values()), 'processed': self.processed,
+                    'busy_ms': round(self.busy_seconds * 1000, 1)}
+
+
+class Pipeline:
+    def __init__(self, stages, finalize=None):
+        """finalize(ctx) строит ctx.result после последней стадии"""
+        # Список стадий не изменяется на месте: add_stage подменяет его копией под
+        # _lock, а потоки стадий берут текущий список целиком и ищут в нём свою стадию
+        self.stages = list(stages)
+        self.finalize = finalize
+        self._started = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _index(stages, name):
+        for i, stage in enumerate(stages):
+            if stage.name == name:
+                return i
+        raise KeyError(name)
+
+    def add_stage(self, stage, before=None, after=None):
+        """Подключение своей стадии; в запущенном конвейере её потоки стартуют сразу,
+        и через неё проходят кадры, ещё не миновавшие место вставки"""
+        with self._lock:
+            stages = list(self.stages)
+            if before is not None:
+                stages.insert(self._index(stages, before), stage)
+            elif after is not None:
+                stages.insert(self._index(stages, after) + 1, stage)
+            else:
+                stages.append(stage)
+            if self._started:
+                stage.start(self._advance)
+            self.stages = stages
+
+    def replace_stage(self, name, stage):
+        """Замена стадии возможна только до запуска: кадры в очереди старой стадии некуда деть"""
+        with self._lock:
+            if self._started:
+                raise RuntimeError('pipeline already started')
+            stages = list(self.stages)
+            stages[self._index(stages, name)] = stage
+            self.stages = stages
+
+    def start(self):
+        with self._lock:
+            self._started = True
+            for stage in self.stages:
+                stage.start(self._advance)
+
+    def submit(self, ctx, timeout=0):
+        """Ставит кадр в первую подходящую стадию; PipelineBusy, если её очередь заполнена"""
+        try:
+            self._dispatch(ctx, 0, block=timeout is None or timeout > 0, timeout=timeout or None)
+        except queue.Full:
+            raise PipelineBusy('frame pipeline is busy')
+        return ctx
+
+    def _dispatch(self, ctx, start, block=True, timeout=None, stages=None):
+        stages = stages if stages is not None else self.stages
+        for stage in stages[start:]:
+            if stage.applies(ctx):
+                stage.put(ctx, block=block, timeout=timeout)
+                return
+        self._complete(ctx)
+
+    def _advance(self, ctx, stage):
+        if ctx.error is not None or ctx.cancelled:
+            ctx.finish()
+            return
+        # Номер стадии и продолжение — по одному и тому же списку стадий
+        stages = self.stages
+        self._dispatch(ctx, stages.index(stage) + 1, stages=stages)
+
+    def _complete(self, ctx):
+        try:
+            if self.finalize is not None:
+                ctx.result = self.finalize(ctx)
+        except Exception as e:
+            logging.error(f'Pipeline finalize error: {e}')
+            ctx.error = e
+        ctx.finish()
+
+    def stats(self):
+        return {stage.name: stage.stats() for stage in self.stages}
@@ -0,0 +1,211 @@
+"""
+Профилирование без внешних зависимостей.
+
+SamplingProfiler — сэмплирующий профайлер: фоновый поток раз в interval секунд
+снимает стеки всех потоков (sys._current_frames) и считает одинаковые стеки.
+Результат — строки "поток;внешняя;...;внутренняя N" (collapsed stacks), которые
+понимают flamegraph.pl, speedscope и inferno. Включается и выключается на ходу.
+
+Trace — разбивка одного запроса на участки (span). Текущая трасса хранится
+в thread-local, поэтому span() в глубине кода ничего не стоит, если трассы нет.
+Стадии конвейера кадров активируют трассу кадра в своих потоках.
+
+SlowRequestLog — последние запросы дольше порога с разбивкой по участкам.
+"""
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+
+class SamplingProfiler:
+    def __init__(self, interval=0.01, max_stacks=50000):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self._stacks = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.samples = 0
+        self.started_at = None
+        self.stopped_at = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval=None):
+        if self.running:
+            return False
+        if interval is not None:
+            self.interval = interval
+        self._stop.clear()
+        self.started_at = time.time()
+        self.stopped_at = None
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        if not self.running:
+            return False
+        self._stop.set()
+        self._thread.join()
+        self.stopped_at = time.time()
+        return True
+
+    def reset(self):
+        with self._lock:
+            self._stacks.clear()
+            self.samples = 0
+
+    @staticmethod
+    def _frame_name(frame):
+        code = frame.f_code
+        return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            sampled = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, f'thread-{ident}'))
+                sampled.append(';'.join(reversed(stack)))
+            with self._lock:
+                for key in sampled:
+                    # Не даём словарю стеков расти без границ при очень разнообразном коде
+                    if key not in self._stacks and len(self._stacks) >= self.max_stacks:
+                        key = '[truncated]'
+                    self._stacks[key] += 1
+                self.samples += 1
+
+    def collapsed(self):
+        """Стеки в формате flame graph: по строке "стек количество" """
+        with self._lock:
+            return ''.join(f'{stack} {count}\n' for stack, count in self._stacks.most_common())
+
+    def dump(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.collapsed())
+
+    def stats(self):
+        with self._lock:
+            return {'running': self.running, 'interval': self.interval, 'samples': self.samples,
+                    'stacks': len(self._stacks), 'started_at': self.started_at, 'stopped_at': self.stopped_at}
+
+
+_local = threading.local()
+
+
+class Trace:
+    """Участки одного запроса: [(имя, секунд)] в порядке завершения"""
+
+    def __init__(self, name, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.spans = []
+        self.started = time.perf_counter()
+        self.timestamp = time.time()
+        self.duration = None
+
+    def add(self, name, seconds):
+        self.spans.append((name, seconds))
+
+    @contextmanager
+    def span(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append((name, time.perf_counter() - started))
+
+    def finish(self):
+        if self.duration is None:
+            self.duration = time.perf_counter() - self.started
+        return self.duration
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'timestamp': self.timestamp,
+            'duration_ms': round(self.finish() * 1000, 2),
+            'spans': [{'name': name, 'ms': round(seconds * 1000, 2)} for name, seconds in self.spans],
+            **self.attrs,
+        }
+
+
+def start_trace(name, **attrs):
+    trace = _local.trace = Trace(name, **attrs)
+    return trace
+
+
+def end_trace():
+    trace = getattr(_local, 'trace', None)
+    _local.trace = None
+    if trace is not None:
+        trace.finish()
+    return trace
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def use_trace(trace):
+    """Делает trace текущей в этом потоке (для стадий, выполняемых в других потоках)"""
+    previous = getattr(_local, 'trace', None)
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+@contextmanager
+def span(name):
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        yield
+        return
+    with trace.span(name):
+        yield
+
+
+class SlowRequestLog:
+    def __init__(self, threshold, size=200):
+        """threshold — секунд; запросы дольше попадают в журнал и в лог сервера"""
+        self.threshold = threshold
+        self._entries = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self.total = 0
+
+    def record(self, trace):
+        if trace is None or trace.finish() < self.threshold:
+            return False
+        entry = trace.to_dict()
+        with self._lock:
+            self._entries.append(entry)
+            self.total += 1
+        breakdown = ' '.join(f"{s['name']}={s['ms']}" for s in entry['spans'])
+        logging.warning(f"Slow request {entry['name']}: {entry['duration_ms']} ms [{breakdown}]")
+        return True
+
+    def entries(self):
+        with self._lock:
+            return list(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {'threshold_ms': round(self.threshold * 1000, 1), 'recorded': self.total,
+                    'kept': len(self._entries)}
@@ -0,0 +1,185 @@
+"""
+Допуск кадров и справедливое распределение мощности детектора между школами.
+Квоты — token bucket на школу и на камеру; очередь на детектор — взвешенный
+round-robin по школам, внутри школы кадры просматриваемых камер и камер
+с тревогой обслуживаются первыми.
+"""
+import threading
+import time
+from collections import defaultdict, deque
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now if now is not None else time.monotonic()
+
+    def try_acquire(self, now=None):
+        now = now if now is not None else time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def retry_after(self):
+        return max(0.0, (1 - self.tokens) / self.rate) if self.rate > 0 else None
+
+
+def _new_tenant_stats():
+    return {'admitted': 0, 'rejected_school_quota': 0, 'rejected_camera_quota': 0,
+            'dropped': 0, 'timed_out': 0, 'completed': 0, 'failed': 0}
+
+
+class AdmissionControl:
+    """Квоты кадров: на школу (school_rate кадров/с) и на камеру (camera_rate кадров/с)"""
+
+    def __init__(self, school_rate, school_burst, camera_rate, camera_burst):
+        self.school_rate = school_rate
+        self.school_burst = school_burst
+        self.camera_rate = camera_rate
+        self.camera_burst = camera_burst
+        self._school_buckets = {}
+        self._camera_buckets = {}
+        self._lock = threading.Lock()
+        self.stats = defaultdict(_new_tenant_stats)
+
+    def admit(self, school_id, camera_id):
+        """(True, None) или (False, секунд до следующей попытки)"""
+        now = time.monotonic()
+        with self._lock:
+            camera = self._camera_buckets.get((school_id, camera_id))
+            if camera is None:
+                camera = self._camera_buckets[(school_id, camera_id)] = TokenBucket(self.camera_rate, self.camera_burst, now)
+            school = self._school_buckets.get(school_id)
+            if school is None:
+                school = self._school_buckets[school_id] = TokenBucket(self.school_rate, self.school_burst, now)
+            # Сначала квота камеры: кадр сверх лимита камеры не должен тратить квоту школы
+            if not camera.try_acquire(now):
+                self.stats[school_id]['rejected_camera_quota'] += 1
+                return False, camera.retry_after()
+            if not school.try_acquire(now):
+                camera.tokens += 1
+                self.stats[school_id]['rejected_school_quota'] += 1
+                return False, school.retry_after()
+            self.stats[school_id]['admitted'] += 1
+            return True, None
+
+    def prune(self, idle_seconds):
+        """Удаляет корзины, к которым не обращались дольше idle_seconds"""
+        deadline = time.monotonic() - idle_seconds
+        with self._lock:
+            for buckets in (self._camera_buckets, self._school_buckets):
+                for key in [k for k, b in buckets.items() if b.updated < deadline]:
+                    del buckets[key]
+
+
+class InferenceJob:
+    __slots__ = ('school_id', 'camera_id', 'priority', 'fn', 'args', 'callback',
+                 'result', 'error', 'dropped', 'cancelled')
+
+    def __init__(self, school_id, camera_id, priority, fn, args, callback=None):
+        self.school_id = school_id
+        self.camera_id = camera_id
+        self.priority = priority
+        self.fn = fn
+        self.args = args
+        self.callback = callback
+        self.result = None
+        self.error = None
+        self.dropped = False
+        self.cancelled = False
+
+    def complete(self):
+        if self.callback is not None:
+            self.callback(self)
+
+
+class JobDropped(Exception):
+    pass
+
+
+class FairScheduler:
+    """Очереди кадров по школам и рабочие потоки, выбирающие их взвешенным round-robin"""
+
+    def __init__(self, stats, max_queue_per_school=8, weights=None, default_weight=1, workers=1):
+        self.stats = stats
+        self.max_queue_per_school = max_queue_per_school
+        self.weights = weights if weights is not None else {}
+        self.default_weight = default_weight
+        self._queues = {}          # school_id -> (deque приоритетных, deque обычных)
+        self._ring = deque()       # школы с ожидающими кадрами, в порядке обслуживания
+        self._served_in_turn = 0
+        self._cond = threading.Condition()
+        for _ in range(workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def submit(self, school_id, camera_id, fn, *args, priority=False, callback=None):
+        """callback(job) вызывается по завершении задачи, в том числе вытесненной"""
+        job = InferenceJob(school_id, camera_id, priority, fn, args, callback)
+        dropped = None
+        with self._cond:
+            queues = self._queues.get(school_id)
+            if queues is None:
+                queues = self._queues[school_id] = (deque(), deque())
+                self._ring.append(school_id)
+            high, normal = queues
+            if len(high) + len(normal) >= self.max_queue_per_school:
+                # Важнее свежий кадр: вытесняем самый старый обычный кадр школы
+                dropped = normal.popleft() if normal else job
+                dropped.dropped = True
+                self.stats[school_id]['dropped'] += 1
+            if dropped is not job:
+                (high if priority else normal).append(job)
+                self._cond.notify()
+        # Обработчики вытесненных задач вызываются вне блокировки
+        if dropped is not None:
+            dropped.complete()
+        return job
+
+    def _next_job(self):
+        while self._ring:
+            school_id = self._ring[0]
+            high, normal = self._queues[school_id]
+            if not high and not normal:
+                self._ring.popleft()
+                del self._queues[school_id]
+                self._served_in_turn = 0
+                continue
+            job = high.popleft() if high else normal.popleft()
+            self._served_in_turn += 1
+            if self._served_in_turn >= self.weights.get(school_id, self.default_weight):
+                self._ring.rotate(-1)
+                self._served_in_turn = 0
+            if job.cancelled:
+                # Кадр не дождался детектора (тайм-аут FrameContext.wait)
+                self.stats[school_id]['timed_out'] += 1
+                continue
+            return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+            try:
+                job.result = job.fn(*job.args)
+                outcome = 'completed'
+            except Exception as e:
+                job.error = e
+                outcome = 'failed'
+            with self._cond:
+                self.stats[job.school_id][outcome] += 1
+            job.complete()
+
+    def queued(self):
+        with self._cond:
+            return {school_id: len(high) + len(normal) for school_id, (high, normal) in self._queues.items()}
@@ -0,0 +1,167 @@
+"""
+Сравнение каналов отправки кадров: HTTP-запрос на кадр (как раньше в симуляторе),
+HTTP с keep-alive сессией и постоянный WebSocket-канал /ingest.
+
+    python ingest_benchmark.py --school school924 --frames 200
+    python ingest_benchmark.py --school school924 --video sample.mp4 --window 8 --json result.json
+
+Сервер ограничивает частоту кадров (FRAME_RATE_PER_CAMERA = 10, FRAME_RATE_PER_SCHOOL = 30):
+по умолчанию кадры идут с частотой --fps 24, по очереди на --cameras 3 камеры
+(8 кадров/с на камеру), чтобы квоты не срабатывали. Отклонённые по квоте кадры
+считаются отдельно (rejected). Для замера предельной пропускной способности
+канала поднимите квоты на сервере и запустите с --fps 0.
+"""
+import argparse
+import base64
+import json
+import time
+
+import cv2
+import numpy as np
+import requests
+
+from ingest_client import IngestClient
+
+SERVER_URL = 'http://localhost:5000'
+QUOTA_ERROR = 'Frame rate quota exceeded'
+
+
+def load_frames(video_path, count):
+    """JPEG-кадры 640x480 из видео или синтетические, если видео не задано"""
+    frames = []
+    if video_path:
+        cap = cv2.VideoCapture(video_path)
+        while len(frames) < count:
+            ret, frame = cap.read()
+            if not ret:
+                if not frames:
+                    raise SystemExit(f'Cannot read frames from {video_path}')
+                cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                continue
+            frame = cv2.resize(frame, (640, 480))
+            frames.append(cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 70])[1].tobytes())
+        cap.release()
+        return frames
+    rng = np.random.default_rng(0)
+    for i in range(count):
+        frame = np.full((480, 640, 3), 90, np.uint8)
+        frame[:, :, 1] = np.linspace(40, 200, 640, dtype=np.uint8)
+        for _ in range(6):
+            x, y = int(rng.integers(0, 560)), int(rng.integers(0, 360))
+            cv2.rectangle(frame, (x, y), (x + 60, y + 120), tuple(int(c) for c in rng.integers(0, 255, 3)), -1)
+        cv2.putText(frame, f'frame {i}', (20, 40), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+        frames.append(cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 70])[1].tobytes())
+    return frames
+
+
+def summarize(name, latencies, errors, rejected, elapsed, total):
+    latencies = sorted(latencies)
+
+    def pct(q):
+        return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 2) if latencies else None
+
+    return {
+        'transport': name,
+        'frames': total,
+        'ok': len(latencies),
+        'rejected': rejected,  # 429 / превышение квоты кадров
+        'errors': errors,
+        'elapsed_s': round(elapsed, 3),
+        'fps': round(len(latencies) / elapsed, 2) if elapsed > 0 else None,
+        'latency_ms': {'p50': pct(0.5), 'p95': pct(0.95), 'p99': pct(0.99)},
+    }
+
+
+def bench_http(frames, token, camera_ids, fps, keep_alive):
+    headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
+    session = requests.Session() if keep_alive else None
+    post = session.post if session else requests.post
+    latencies, errors, rejected = [], 0, 0
+    start = time.perf_counter()
+    for i, jpeg in enumerate(frames):
+        if fps:
+            delay = start + i / fps - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        body = {'camera_id': camera_ids[i % len(camera_ids)], 'frame': base64.b64encode(jpeg).decode('utf-8')}
+        t0 = time.perf_counter()
+        try:
+            resp = post(f'{SERVER_URL}/video-frame-annotated', json=body, headers=headers, timeout=30)
+            if resp.ok:
+                latencies.append(time.perf_counter() - t0)
+            elif resp.status_code == 429:
+                rejected += 1
+            else:
+                errors += 1
+        except requests.RequestException:
+            errors += 1
+    elapsed = time.perf_counter() - start
+    if session:
+        session.close()
+    return summarize('http-keepalive' if keep_alive else 'http', latencies, errors, rejected, elapsed, len(frames))
+
+
+def bench_ws(frames, token, camera_ids, fps, window):
+    latencies, errors, rejected = [], [0], [0]
+
+    def on_result(result, latency):
+        if result.get('error') == QUOTA_ERROR:
+            rejected[0] += 1
+        elif 'error' in result or latency is None:
+            errors[0] += 1
+        else:
+            latencies.append(latency)
+
+    client = IngestClient(SERVER_URL, token, on_result=on_result, window=window)
+    client.connect()
+    start = time.perf_counter()
+    for i, jpeg in enumerate(frames):
+        if fps:
+            delay = start + i / fps - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        # Ждём освобождения окна, чтобы не пропускать кадры
+        client.send(camera_ids[i % len(camera_ids)], jpeg, block=True)
+    client.wait_idle(timeout=60)
+    elapsed = time.perf_counter() - start
+    client.close()
+    return summarize(f'websocket(window={window})', latencies, errors[0], rejected[0], elapsed, len(frames))
+
+
+def main():
+    global SERVER_URL
+    parser = argparse.ArgumentParser(description='HTTP vs WebSocket frame ingestion benchmark')
+    parser.add_argument('--server', default=SERVER_URL)
+    parser.add_argument('--school', required=True, help='registered school id (token via /get-token)')
+    parser.add_argument('--camera', default='bench_camera', help='camera id prefix')
+    parser.add_argument('--cameras', type=int, default=3, help='spread frames round-robin over N camera ids')
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--video', default=None)
+    parser.add_argument('--fps', type=float, default=24,
+                        help='total send rate, kept under the frame quotas; 0 — as fast as possible')
+    parser.add_argument('--window', type=int, default=4, help='frames in flight on the WebSocket channel')
+    parser.add_argument('--json', dest='json_out', default=None)
+    args = parser.parse_args()
+    SERVER_URL = args.server.rstrip('/')
+    if args.cameras < 1:
+        parser.error('--cameras must be at least 1')
+    camera_ids = [args.camera] if args.cameras == 1 else [f'{args.camera}_{i}' for i in range(args.cameras)]
+
+    resp = requests.get(f'{SERVER_URL}/get-token/{args.school}', timeout=5)
+    resp.raise_for_status()
+    token = resp.json()['token']
+    frames = load_frames(args.video, args.frames)
+
+    results = [
+        bench_http(frames, token, camera_ids, args.fps, keep_alive=False),
+        bench_http(frames, token, camera_ids, args.fps, keep_alive=True),
+        bench_ws(frames, token, camera_ids, args.fps, args.window),
+    ]
+    print(json.dumps(results, indent=2))
+    if args.json_out:
+        with open(args.json_out, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
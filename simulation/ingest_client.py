@@ -0,0 +1,90 @@
+"""
+Клиент постоянного WebSocket-канала приёма кадров (/ingest).
+Камера подключается один раз с JWT, затем отправляет JPEG-кадры бинарными
+сообщениями с порядковым номером; результаты детекции приходят асинхронно
+по тому же соединению.
+"""
+import threading
+import time
+import logging
+
+import socketio
+
+INGEST_NAMESPACE = '/ingest'
+
+
+class IngestClient:
+    def __init__(self, server_url, token, on_result=None, window=4):
+        """window — сколько кадров может ждать ответа; новые кадры сверх окна пропускаются"""
+        self.server_url = server_url
+        self.token = token
+        self.on_result = on_result
+        self.window = window
+        self.seq = 0
+        self.sent = 0
+        self.skipped = 0
+        self._in_flight = {}  # seq -> время отправки
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self.sio = socketio.Client(reconnection=True)
+        self.sio.on('frame_result', self._handle_result, namespace=INGEST_NAMESPACE)
+        self.sio.on('disconnect', self._handle_disconnect, namespace=INGEST_NAMESPACE)
+
+    def connect(self):
+        self.sio.connect(self.server_url, namespaces=[INGEST_NAMESPACE],
+                         auth={'token': self.token}, transports=['websocket'])
+
+    @property
+    def connected(self):
+        return self.sio.connected
+
+    def send(self, camera_id, jpeg_bytes, annotated=True, block=False):
+        """Отправляет кадр; возвращает seq или None, если окно заполнено (block=True — ждать места)"""
+        with self._lock:
+            while len(self._in_flight) >= self.window:
+                if not block:
+                    self.skipped += 1
+                    return None
+                self._idle.wait()
+            self.seq += 1
+            seq = self.seq
+            self._in_flight[seq] = time.perf_counter()
+        self.sio.emit('frame', {
+            'camera_id': camera_id,
+            'seq': seq,
+            'frame': bytes(jpeg_bytes),
+            'annotated': annotated
+        }, namespace=INGEST_NAMESPACE)
+        self.sent += 1
+        return seq
+
+    def _handle_result(self, data):
+        with self._lock:
+            sent_at = self._in_flight.pop(data.get('seq'), None)
+            self._idle.notify_all()
+        latency = time.perf_counter() - sent_at if sent_at is not None else None
+        if self.on_result is not None:
+            try:
+                self.on_result(data, latency)
+            except Exception as e:
+                logging.error(f'Ingest result handler error: {e}')
+
+    def _handle_disconnect(self):
+        # Ответы на кадры, отправленные до обрыва, уже не придут
+        with self._lock:
+            self._in_flight.clear()
+            self._idle.notify_all()
+
+    def wait_idle(self, timeout=None):
+        """Ждёт ответов на все отправленные кадры"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._lock:
+            while self._in_flight:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def close(self):
+        self.sio.disconnect()
@@ -57,7 +57,7 @@ school_frame = ttk.LabelFrame(root, text='Настройки школы', paddin
 school_frame.pack(fill='x', padx=10, pady=5)
 
 ttk.Label(school_frame, text='ID школы:').grid(row=0, column=0, sticky='w', padx=5)
-school_id_var = tk.StringVar(value='school_1')
+school_id_var = tk.StringVar(value='school924')
 school_id_entry = ttk.Entry(school_frame, textvariable=school_id_var, width=30)
 school_id_entry.grid(row=0, column=1, padx=5, pady=5)
 
@@ -107,8 +107,8 @@ status_frame.pack(fill='x', padx=10, pady=5)
 ttk.Label(status_frame, text='Статус: Данные отправляются каждую секунду после применения токена').pack()
 
 # Генерируем токен по умолчанию
-generate_token('school_1')
-token_status_label.config(text='Токен: создан для "school_1"', foreground='green')
+generate_token('school924')
+token_status_label.config(text='Токен: создан для "school924"', foreground='green')
 
 # Запуск потока отправки данных
 threading.Thread(target=send_data_loop, daemon=True).start()
@@ -12,11 +12,14 @@ import cv2
 import base64
 import logging
 import os
+from ingest_client import IngestClient
 
 # Конфигурация
 SERVER_URL = 'http://localhost:5000'
 SECRET_KEY = 'supersecretkey'
-DEFAULT_SCHOOL_ID = 'school_1'
+DEFAULT_SCHOOL_ID = 'school924'  # /get-token выдаёт токены только зарегистрированным школам
+MAX_CAMERA_FPS = 10              # квота сервера FRAME_RATE_PER_CAMERA
+QUOTA_ERROR = 'Frame rate quota exceeded'
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 
@@ -50,6 +53,13 @@ class VideoSimulator:
         self.status_label = ttk.Label(conn_frame, text='Не подключено', foreground='red')
         self.status_label.grid(row=0, column=3, padx=10)
         
+        # HTTP — запрос на каждый кадр; WebSocket — одно постоянное соединение на камеру
+        ttk.Label(conn_frame, text='Канал:').grid(row=1, column=0, sticky='w', pady=(5, 0))
+        self.transport_var = tk.StringVar(value='WebSocket')
+        self.transport_combo = ttk.Combobox(conn_frame, textvariable=self.transport_var,
+                                            values=('WebSocket', 'HTTP'), state='readonly', width=12)
+        self.transport_combo.grid(row=1, column=1, sticky='w', padx=5, pady=(5, 0))
+        
         # --- Добавление камер ---
         add_frame = ttk.LabelFrame(self.root, text='Добавить видеокамеру', padding=10)
         add_frame.pack(fill='x', padx=10, pady=5)
@@ -163,10 +173,10 @@ class VideoSimulator:
         
         try:
             fps = float(self.fps_var.get())
-            if fps <= 0 or fps > 30:
+            if fps <= 0 or fps > MAX_CAMERA_FPS:
                 raise ValueError()
         except:
-            messagebox.showerror('Ошибка', 'FPS должен быть числом от 0.1 до 30')
+            messagebox.showerror('Ошибка', f'FPS должен быть числом от 0.1 до {MAX_CAMERA_FPS} (квота сервера на камеру)')
             return
         
         # Выбор видеофайла
@@ -195,7 +205,9 @@ class VideoSimulator:
             'running': False,
             'thread': None,
             'cap': None,
-            'people_count': 0
+            'people_count': 0,
+            'retry_at': 0.0,    # до этого момента сервер отклоняет кадры по квоте
+            'skipped': 0
         }
         
         # Добавляем в дерево
@@ -231,7 +243,8 @@ class VideoSimulator:
         cam['running'] = False
         
         self.cameras_tree.set(camera_id, 'status', 'Остановлена')
-        self.log(f'Камера {camera_id} остановлена')
+        skipped = f', пропущено по квоте кадров: {cam["skipped"]}' if cam['skipped'] else ''
+        self.log(f'Камера {camera_id} остановлена{skipped}')
     
     def camera_loop(self, camera_id):
         cam = self.cameras[camera_id]
@@ -244,6 +257,19 @@ class VideoSimulator:
         
         interval = 1.0 / cam['fps']
         headers = {'Authorization': f'Bearer {self.token}', 'Content-Type': 'application/json'}
+        session = requests.Session()  # keep-alive соединение для HTTP-режима
+        
+        # Постоянный канал: авторизация один раз, кадры без заголовков и base64
+        ingest = None
+        if self.transport_var.get() == 'WebSocket':
+            ingest = IngestClient(SERVER_URL, self.token,
+                                  on_result=lambda result, latency, cid=camera_id: self.handle_ingest_result(cid, result))
+            try:
+                ingest.connect()
+                self.log(f'Камера {camera_id}: WebSocket-канал открыт')
+            except Exception as e:
+                self.log(f'Камера {camera_id}: WebSocket недоступен ({e}), используется HTTP')
+                ingest = None
         
         while cam['running']:
             ret, frame = cap.read()
@@ -255,12 +281,25 @@ class VideoSimulator:
                 if not ret:
                     break
             
+            # Квота кадров исчерпана (например, общая квота школы): кадр пропускаем молча
+            if time.monotonic() < cam['retry_at']:
+                cam['skipped'] += 1
+                time.sleep(interval)
+                continue
+            
             try:
                 # Уменьшаем размер для быстрой передачи
                 frame_small = cv2.resize(frame, (640, 480))
                 
                 # Кодируем в JPEG
                 _, buffer = cv2.imencode('.jpg', frame_small, [cv2.IMWRITE_JPEG_QUALITY, 70])
+                
+                if ingest is not None:
+                    # Ответ придёт асинхронно в handle_ingest_result
+                    ingest.send(camera_id, buffer.tobytes())
+                    time.sleep(interval)
+                    continue
+                
                 frame_b64 = base64.b64encode(buffer).decode('utf-8')
                 
                 # Отправляем на сервер (используем annotated эндпоинт для поддержки просмотра)
@@ -270,7 +309,7 @@ class VideoSimulator:
                 }
                 
                 # Используем annotated эндпоинт для поддержки просмотра с bounding boxes
-                resp = requests.post(f'{SERVER_URL}/video-frame-annotated', json=data, headers=headers, timeout=10)
+                resp = session.post(f'{SERVER_URL}/video-frame-annotated', json=data, headers=headers, timeout=10)
                 
                 if resp.ok:
                     result = resp.json()
@@ -280,6 +319,8 @@ class VideoSimulator:
                     # Обновляем UI в главном потоке
                     self.root.after(0, lambda cid=camera_id, cnt=people_count: 
                                    self.cameras_tree.set(cid, 'people', str(cnt)))
+                elif resp.status_code == 429:
+                    self.defer_camera(camera_id, float(resp.headers.get('Retry-After', 1)))
                 else:
                     self.log(f'Ошибка отправки кадра {camera_id}: {resp.status_code}')
                     
@@ -289,8 +330,29 @@ class VideoSimulator:
             time.sleep(interval)
         
         cap.release()
+        session.close()
+        if ingest is not None:
+            ingest.close()
         self.root.after(0, lambda: self.cameras_tree.set(camera_id, 'status', 'Остановлена'))
     
+    def defer_camera(self, camera_id, retry_after):
+        cam = self.cameras.get(camera_id)
+        if cam is not None:
+            cam['skipped'] += 1
+            cam['retry_at'] = time.monotonic() + retry_after
+    
+    def handle_ingest_result(self, camera_id, result):
+        if result.get('error') == QUOTA_ERROR:
+            self.defer_camera(camera_id, float(result.get('retry_after', 1)))
+            return
+        if 'error' in result:
+            self.root.after(0, lambda: self.log(f'Ошибка кадра {camera_id}: {result["error"]}'))
+            return
+        people_count = result.get('people_count', 0)
+        if camera_id in self.cameras:
+            self.cameras[camera_id]['people_count'] = people_count
+            self.root.after(0, lambda: self.cameras_tree.set(camera_id, 'people', str(people_count)))
+    
     def start_selected(self):
         selection = self.cameras_tree.selection()
         if not selection:
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Модули сервера импортируются как в server/app.py: from pipeline import ...
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
@@ -0,0 +1,28 @@
+from capture import CaptureReader, CaptureWriter, KIND_SENSOR, index_path
+
+
+def _write(path, n):
+    writer = CaptureWriter(path)
+    for i in range(n):
+        writer.record_sensor('school', f'sensor{i}', 20.0 + i, 1000.0 + i)
+    writer.close()
+
+
+def test_reader_uses_complete_index(tmp_path):
+    path = str(tmp_path / 'day.sscap')
+    _write(path, 3)
+    reader = CaptureReader(path)
+    assert len(reader) == 3
+    assert [r.source_id for r in reader] == ['sensor0', 'sensor1', 'sensor2']
+
+
+def test_reader_rescans_when_index_is_short(tmp_path):
+    path = str(tmp_path / 'day.sscap')
+    _write(path, 3)
+    # Индекс потерял последнюю запись (например, упали между записью данных и индекса)
+    with open(index_path(path), 'r+b') as idx:
+        idx.truncate(2 * (len(idx.read()) // 3))
+    reader = CaptureReader(path)
+    assert len(reader) == 3
+    assert reader.counts() == {KIND_SENSOR: 3}
+    assert list(reader)[-1].source_id == 'sensor2'
@@ -0,0 +1,130 @@
+import random
+import threading
+import time
+from collections import defaultdict
+
+import pytest
+
+from pipeline import FrameContext, FrameSequencer, Pipeline, SchedulerStage, Stage
+from scheduler import FairScheduler, JobDropped, _new_tenant_stats
+
+
+def test_sequencer_rejects_stale_frames():
+    seq = FrameSequencer()
+    key = ('school', 'cam')
+    first, second = seq.next(key), seq.next(key)
+    assert (first, second) == (1, 2)
+    assert seq.accept('store', key, second)
+    assert not seq.accept('store', key, first)
+    # Стадии учитываются независимо
+    assert seq.accept('publish', key, first)
+    assert seq.next(('school', 'other')) == 1
+
+
+def test_sequencer_expire_forgets_idle_cameras():
+    seq = FrameSequencer()
+    seq.next(('school', 'cam'))
+    seq.accept('store', ('school', 'cam'), 1)
+    assert seq.expire(0) == 1
+    assert seq.next(('school', 'cam')) == 1
+    assert seq.accept('store', ('school', 'cam'), 1)
+
+
+def test_store_sees_camera_frames_in_order():
+    """Многопоточные decode/render перемешивают кадры, store принимает только новые"""
+    rng = random.Random(0)
+    rng_lock = threading.Lock()
+    sequencer = FrameSequencer()
+    stored = []
+
+    def jitter(ctx):
+        with rng_lock:
+            delay = rng.random() * 0.004
+        time.sleep(delay)
+
+    def store(ctx):
+        if sequencer.accept('store', (ctx.school_id, ctx.camera_id), ctx.seq):
+            stored.append(ctx.seq)
+
+    scheduler = FairScheduler(defaultdict(_new_tenant_stats), max_queue_per_school=64)
+    pipeline = Pipeline([
+        Stage('decode', jitter, workers=2),
+        SchedulerStage('infer', lambda ctx: None, scheduler),
+        Stage('render', jitter, workers=2),
+        Stage('store', store),
+    ])
+    pipeline.start()
+
+    frames = [pipeline.submit(FrameContext('school', 'cam', i, seq=sequencer.next(('school', 'cam'))), timeout=None)
+              for i in range(30)]
+    for ctx in frames:
+        ctx.wait(5)
+
+    assert stored == sorted(stored)
+    assert len(set(stored)) == len(stored)
+    assert stored[-1] == 30
+
+
+def test_inference_errors_are_counted_as_failed():
+    stats = defaultdict(_new_tenant_stats)
+    scheduler = FairScheduler(stats)
+
+    def infer(ctx):
+        if ctx.frame_bytes == b'bad':
+            raise ValueError('model error')
+
+    pipeline = Pipeline([SchedulerStage('infer', infer, scheduler)], finalize=lambda ctx: 'ok')
+    pipeline.start()
+
+    assert pipeline.submit(FrameContext('school', 'cam', b'ok')).wait(5) == 'ok'
+    with pytest.raises(ValueError):
+        pipeline.submit(FrameContext('school', 'cam', b'bad')).wait(5)
+    assert stats['school']['completed'] == 1
+    assert stats['school']['failed'] == 1
+
+
+def test_frames_timed_out_in_queue_are_counted():
+    stats = defaultdict(_new_tenant_stats)
+    scheduler = FairScheduler(stats)
+    release = threading.Event()
+
+    pipeline = Pipeline([SchedulerStage('infer', lambda ctx: release.wait(5), scheduler)])
+    pipeline.start()
+
+    busy = pipeline.submit(FrameContext('school', 'cam', b'first'))
+    late = pipeline.submit(FrameContext('school', 'cam', b'second'))
+    with pytest.raises(JobDropped):
+        late.wait(0.05)
+    release.set()
+    busy.wait(5)
+    # Отменённая задача пропускается, когда до неё доходит очередь
+    deadline = time.monotonic() + 5
+    while stats['school']['timed_out'] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert stats['school']['timed_out'] == 1
+    assert stats['school']['completed'] == 1
+
+
+def test_add_stage_while_running_keeps_stage_order():
+    def visit(name):
+        def fn(ctx):
+            ctx.data.setdefault('visited', []).append(name)
+            time.sleep(0.001)
+        return fn
+
+    pipeline = Pipeline([Stage('decode', visit('decode'), workers=2),
+                         Stage('render', visit('render'), workers=2),
+                         Stage('store', visit('store'))])
+    pipeline.start()
+
+    frames = [pipeline.submit(FrameContext('school', 'cam', i), timeout=None) for i in range(20)]
+    pipeline.add_stage(Stage('extra', visit('extra'), workers=2), before='store')
+    frames += [pipeline.submit(FrameContext('school', 'cam', i), timeout=None) for i in range(20, 40)]
+    for ctx in frames:
+        ctx.wait(5)
+
+    for ctx in frames:
+        # Стадии не пропускаются и не повторяются; новую стадию кадр мог уже миновать
+        assert ctx.data['visited'] in (['decode', 'render', 'store'], ['decode', 'render', 'extra', 'store'])
+    assert all('extra' in ctx.data['visited'] for ctx in frames[20:])
+    assert pipeline.stats()['extra']['processed'] >= 20